@@ -0,0 +1,199 @@
+import asyncio
+import collections
+import math
+import threading
+import time
+
+import metrics
+
+# Reasons of rejected requests
+QUEUE_FULL = "queue_full"
+TIMEOUT = "timeout"
+
+
+class OverloadedError(Exception):
+    # Request was not admitted, retry_after is the suggested delay in whole seconds
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Service overloaded ({reason}), retry after {retry_after} s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _AsyncWaiter:
+    # Coroutine waiting for a slot; the slot is handed over by release() or a higher limit
+    __slots__ = ("loop", "future", "granted")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveLimiter:
+    # Limits the number of requests waiting on the security server at the same time. The limit follows
+    # the latency of the security server: while the short-term average stays within `tolerance` times the
+    # lowest latency of recent requests it grows, when requests slow down or fail it shrinks. Requests
+    # above the limit wait in a queue of at most max_queue requests for queue_timeout seconds, after that
+    # they are rejected with OverloadedError instead of piling up.
+    def __init__(self, min_limit: int = 4, max_limit: int = 200, initial_limit: int = 20, max_queue: int = 50,
+                 queue_timeout: float = 2.0, tolerance: float = 2.0, smoothing: float = 0.2, window: int = 100):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.window = window
+        self._limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self._condition = threading.Condition()
+        self._async_waiters = collections.deque()
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        # Latency: exponential average of recent requests, lowest latency of the current and last window
+        self.latency = None
+        self.baseline = None
+        self._window_min = math.inf
+        self._samples = 0
+        metrics.admission_limit.set(self.limit)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self, timeout: float = None):
+        # Take a slot, waiting up to timeout (default queue_timeout) seconds for it
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._condition:
+            if not self.queued and self.in_flight < self.limit:
+                self._admit()
+                return
+            if self.queued >= self.max_queue:
+                self._reject(QUEUE_FULL)
+            deadline = time.monotonic() + timeout
+            self.queued += 1
+            metrics.admission_queued.set(self.queued)
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(TIMEOUT)
+                    self._condition.wait(remaining)
+                self._admit()
+            finally:
+                self.queued -= 1
+                metrics.admission_queued.set(self.queued)
+
+    async def aacquire(self, timeout: float = None):
+        # Same as acquire() for coroutines, waiting does not block the event loop or a thread
+        timeout = self.queue_timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            if not self.queued and self.in_flight < self.limit:
+                self._admit()
+                return
+            if self.queued >= self.max_queue:
+                self._reject(QUEUE_FULL)
+            waiter = _AsyncWaiter(loop)
+            self._async_waiters.append(waiter)
+            self.queued += 1
+            metrics.admission_queued.set(self.queued)
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            with self._condition:
+                if not waiter.granted:
+                    self._withdraw(waiter)
+                    self._reject(TIMEOUT)
+        except BaseException:
+            # Cancelled while waiting: a slot handed over in the meantime is given back
+            with self._condition:
+                if not waiter.granted:
+                    self._withdraw(waiter)
+            if waiter.granted:
+                self.release()
+            raise
+
+    def _withdraw(self, waiter: _AsyncWaiter):
+        self._async_waiters.remove(waiter)
+        self.queued -= 1
+        metrics.admission_queued.set(self.queued)
+
+    def _grant_async(self):
+        # Hand free slots to waiting coroutines in arrival order, called with the condition held
+        while self._async_waiters and self.in_flight < self.limit:
+            waiter = self._async_waiters.popleft()
+            waiter.granted = True
+            self.queued -= 1
+            metrics.admission_queued.set(self.queued)
+            self._admit()
+            waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            metrics.admission_in_flight.set(self.in_flight)
+            self._grant_async()
+            self._condition.notify()
+
+    def observe(self, latency: float, failed: bool = False):
+        # Adjust the limit after a request to the security server
+        with self._condition:
+            if failed:
+                # Errors and timeouts of an overloaded security server shrink the limit at once
+                self._limit = max(self.min_limit, self._limit * 0.9)
+            else:
+                self._sample(latency)
+                gradient = max(0.5, min(1.0, self.tolerance * self.baseline / self.latency)) if self.latency else 1.0
+                target = self._limit * gradient + math.sqrt(self._limit)
+                # Do not grow while the limit is not used, latency of a few requests says nothing about more
+                if self.in_flight < self._limit / 2:
+                    target = min(target, self._limit)
+                self._limit = min(self.max_limit, max(self.min_limit,
+                                                      self._limit * (1 - self.smoothing) + target * self.smoothing))
+            metrics.admission_limit.set(self.limit)
+            self._grant_async()
+            self._condition.notify_all()
+
+    def _sample(self, latency: float):
+        self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+        self._window_min = min(self._window_min, latency)
+        self._samples += 1
+        self.baseline = latency if self.baseline is None else min(self.baseline, latency)
+        if self._samples >= self.window:
+            # A new window keeps the baseline current when the security server gets slower for good
+            self.baseline = self._window_min
+            self._window_min = math.inf
+            self._samples = 0
+
+    def _admit(self):
+        self.in_flight += 1
+        metrics.admission_in_flight.set(self.in_flight)
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        raise OverloadedError(reason, self.retry_after())
+
+    def retry_after(self) -> int:
+        # Time for the queue in front of the request to be served, at least one second
+        latency = self.latency or self.queue_timeout
+        return max(1, math.ceil(latency * (self.queued + 1) / max(self.limit, 1)))
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "max_queue": self.max_queue,
+                "rejected": self.rejected,
+                "latency": round(self.latency, 4) if self.latency is not None else None,
+                "baseline_latency": round(self.baseline, 4) if self.baseline is not None else None,
+            }
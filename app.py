@@ -1,20 +1,17 @@
 import sys
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import (Flask, Response, g, render_template, stream_template, request, jsonify, send_from_directory,
+                   url_for)
 from flask_bootstrap import Bootstrap
 
 import utils
+import bulk
+import metrics
+import admission
+import functools
 import os
+import time
 import logging
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.resources import Resource, SERVICE_NAME
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.sdk.trace.sampling import TraceIdRatioBased
+import telemetry
 
 
 # Reading application parameters from config file
@@ -48,74 +45,187 @@ certificate_full_path = os.path.join(crt_directory, cert)
 
 # If key or certificate not found, generate them
 if not os.path.exists(private_key_full_path) or not os.path.exists(certificate_full_path):
-    logger.info(f"Key: {key} or certificate {cert} not found in directory {crt_directory}")
+    logger.info("Key: %s or certificate %s not found in directory %s", key, cert, crt_directory)
     utils.generate_key_cert(key, cert, crt_directory)
 
-if conf.telemetry_enabled == "true" :
-    logger.info("Telemetry enabled")
-    # Set up tracer provider with service name
-    trace.set_tracer_provider(
-        TracerProvider(
-            resource=Resource.create({SERVICE_NAME: conf.telemetry_own_service_name}),
-            sampler=TraceIdRatioBased(float(conf.telemetry_sample_ratio))
-        )
-    )
-
-    otlp_exporter = OTLPSpanExporter(
-        endpoint=conf.telemetry_endpoint,  # OTLP gRPC port by default
-        insecure=True  # No TLS (if Collector has no mTLS)
-    )
-
-    trace.get_tracer_provider().add_span_processor(
-        BatchSpanProcessor(otlp_exporter)
-    )
-
 # Initialize Flask application
 app = Flask(__name__)
-if conf.telemetry_enabled == "true" :
-    # Instrument Flask (automatically wraps routes in spans)
-    RequestsInstrumentor().instrument()
-    FlaskInstrumentor().instrument_app(app)
+# OpenTelemetry is imported only when enabled
+telemetry.setup_telemetry(conf, app)
 
 Bootstrap(app)
 logger.info("Flask application initialized.")
 
+# Continue mutations and ASiC container downloads queued before restart (flask run, uvicorn,
+# gunicorn without preload); with gunicorn preload_app the workers do it after fork
+utils.resume_background_work(conf)
+
+# Largest page of search results that can be requested
+MAX_PAGE_SIZE = 1000
+
+
+def metrics_route() -> str:
+    # Route pattern instead of the actual path keeps the number of metric series bounded
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+# Measure every request for the /metrics endpoint
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    metrics.http_requests_in_flight.inc(route=metrics_route())
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are measured until the first part of the body is ready
+    if 'metrics_start' in g:
+        metrics.http_request_duration.observe(time.perf_counter() - g.metrics_start, route=metrics_route(),
+                                              method=request.method, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if 'metrics_start' not in g:
+        return
+    metrics.http_requests_in_flight.dec(route=metrics_route())
+    if exc is not None:
+        metrics.http_request_exceptions.inc(route=metrics_route(), method=request.method)
+
+
+def admission_required() -> bool:
+    # Forms and queued mutations are served without waiting for the security server
+    if request.method == 'GET':
+        return bool(request.args)
+    return request.endpoint == 'search_user' or not async_requested()
+
+
+def overloaded_response(error: admission.OverloadedError):
+    # The search page shows an error page, API routes answer with JSON
+    if request.endpoint != 'search_user':
+        response = jsonify(message=str(error))
+    else:
+        response = app.make_response(render_template('error.html', error_message=error, current_page='index'))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def admission_controlled(view):
+    # Limit concurrent requests of the route waiting on the security server ([admission] section);
+    # requests above the limit wait briefly and are rejected with 503 and Retry-After
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        limiter = utils.get_admission_limiter(conf)
+        if limiter is None or not admission_required():
+            return view(*args, **kwargs)
+        try:
+            limiter.acquire()
+        except admission.OverloadedError as e:
+            metrics.admission_rejected.inc(route=metrics_route(), reason=e.reason)
+            logger.warning("Request to %s rejected: %s", request.path, e)
+            return overloaded_response(e)
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            limiter.release()
+            raise
+        if response.is_streamed:
+            # The security server is read while the body is sent, the slot is held until it is complete
+            response.call_on_close(limiter.release)
+        else:
+            limiter.release()
+        return response
+    return wrapper
+
 # Handle HTTP requests to the home page
 @app.route('/', methods=['GET', 'POST'])
+@admission_controlled
 def search_user():
-    logger.debug(f"Received {'POST' if request.method == 'POST' else 'GET'} request to '/' route.")
-    if request.method == 'POST':  # Handle POST request for person search form
-        search_field = request.form.get('search_field')
-        search_value = request.form.get('search_value')
-
-        logger.debug(f"Received search parameters: {search_field} : {search_value}")
+    logger.debug("Received %s request to '/' route.", request.method)
+    # Search parameters come from the search form (POST) or from pagination links (GET)
+    search_field = request.values.get('search_field')
+    search_value = request.values.get('search_value')
+    if request.method == 'POST' or search_field:  # Handle person search
+        logger.debug("Received search parameters: %s : %s", search_field, search_value)
+        page = request.values.get('page', 1, type=int)
+        size = min(request.values.get('size', conf.search_page_size, type=int), MAX_PAGE_SIZE)
 
         try:
+            if conf.search_stream_results == "true":
+                # Rows are sent to the browser while the result is received from the security server
+                data = utils.iter_person_from_service(search_field, search_value, conf)
+                return stream_template('list_person.html', data=data, current_page='index')
+            if size > 0:
+                # Only the requested page is rendered, next pages are loaded by the browser on demand
+                # The search form starts a new search, pagination links (GET) page through its result
+                pagination = utils.get_person_page(search_field, search_value, page, size, conf,
+                                                   refresh=request.method == 'POST')
+                return render_template('list_person.html', data=pagination['items'],
+                                       pagination=pagination, current_page='index')
             # Query for person information
             data = utils.get_person_from_service(search_field, search_value, conf)
         except Exception as e:
             # In case of error, render error page
-            logger.error(f"Error occurred: {str(e)}")
+            logger.error("Error occurred: %s", e)
             return render_template('error.html', error_message=e, current_page='index')
         return render_template('list_person.html', data=data, current_page='index')
 
     # If GET request, render the search form
     return render_template('search_form.html', current_page='index')
 
+# Handle request for one page of search results as JSON
+@app.route('/search/page')
+def search_page():
+    logger.debug("Received GET request to '/search/page' route.")
+    search_field = request.args.get('search_field')
+    search_value = request.args.get('search_value')
+    page = request.args.get('page', 1, type=int)
+    size = min(request.args.get('size', conf.search_page_size, type=int), MAX_PAGE_SIZE)
+    if size <= 0:
+        size = MAX_PAGE_SIZE
+    try:
+        pagination = utils.get_person_page(search_field, search_value, page, size, conf)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return jsonify(message=f"Error processing search request: {str(e)}"), 502
+    return jsonify(pagination)
+
+def async_requested() -> bool:
+    # Mutation is queued if requested with ?async=true or by default with [jobs] async_mutations = true
+    return request.args.get('async', conf.jobs_async_mutations) == 'true'
+
+
+def queue_mutation(operation: str, data):
+    # Persist the mutation and acknowledge it at once, the result is available at /jobs/<job_id>
+    try:
+        bulk.validate_mutation_items(operation, [data])
+    except ValueError as e:
+        return jsonify(message=f"Error processing {operation} request: {str(e)}"), 422
+    job_id = utils.get_job_queue(conf).submit(operation, data)
+    response = jsonify(message=f"Request accepted as job {job_id}", job_id=job_id,
+                       status_url=url_for('job_status', job_id=job_id))
+    response.headers['Location'] = url_for('job_status', job_id=job_id)
+    return response, 202
+
 # Handle person creation
 @app.route('/create', methods=['GET', 'POST'])
+@admission_controlled
 def create_user():
-    logger.debug(f"Received {'POST' if request.method == 'POST' else 'GET'} request to '/create' route.")
+    logger.debug("Received %s request to '/create' route.", request.method)
     if request.method == 'POST':  # Handle POST request to create a new person
         try:
             form_data = request.get_json()  # Read form data
-            logger.debug(f"Received creation request with parameters: {form_data}")
+            logger.debug("Received creation request with parameters: %s", form_data)
+            if async_requested():
+                return queue_mutation('create', form_data)
             # Call function to add new person
             response = utils.service_add_person(form_data, conf)
             resp = jsonify(message=response.body), response.status_code
             return resp
         except Exception as e:
-            logger.debug(f"Error occurred: {str(e)}")
+            logger.debug("Error occurred: %s", e)
             resp = jsonify(message=f'Error creating person object: {str(e)}'), 422
             return resp
 
@@ -124,71 +234,218 @@ def create_user():
 
 # Handle person data editing
 @app.route('/edit', methods = ['POST'])
+@admission_controlled
 def edit_user():
     logger.debug("Received POST request to '/edit' route.")
     data = request.get_json()  # Get edit data
-    logger.debug(f"Received edit data: {data}")
+    logger.debug("Received edit data: %s", data)
+    if async_requested():
+        return queue_mutation('edit', data)
     try:
         # Call function to edit person data
         http_resp = utils.edit_person_in_service(data, conf)
     except Exception as e:
-        logger.error(f"Error occurred: {str(e)}")
+        logger.error("Error occurred: %s", e)
         resp = jsonify(message=f"Error processing edit request: {str(e)}"), 500
         return resp
     return jsonify(message=http_resp.body), http_resp.status_code
 
 # Handle person deletion
 @app.route('/delete', methods = ['POST'])
+@admission_controlled
 def delete_person():
     logger.debug("Received POST request to '/delete' route.")
     data = request.get_json()   # Get person data to delete
-    logger.debug(f"Received deletion request: {data}")
+    logger.debug("Received deletion request: %s", data)
+    if async_requested():
+        return queue_mutation('delete', data)
     try:
         # Call function to delete person
         http_resp = utils.service_delete_person(data, conf)
     except Exception as e:
-        logger.error(f"Error occurred: {str(e)}")
+        logger.error("Error occurred: %s", e)
         resp = jsonify(message=f"Error processing deletion request: {str(e)}"), 500
         return resp
     return jsonify(message= http_resp.body), http_resp.status_code
 
+# Handle status request of a queued person mutation
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    logger.debug("Received GET request to '/jobs/%s' route.", job_id)
+    job = utils.get_job_queue(conf).store.get(job_id)
+    if job is None:
+        return jsonify(message=f"Job {job_id} not found"), 404
+    return jsonify(job)
+
+# Handle person search with result streamed as NDJSON, one person per line
+@app.route('/stream/search')
+@admission_controlled
+def stream_search():
+    logger.debug("Received GET request to '/stream/search' route.")
+    search_field = request.args.get('search_field')
+    search_value = request.args.get('search_value')
+    try:
+        persons = utils.iter_person_from_service(search_field, search_value, conf)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return jsonify(message=f"Error processing search request: {str(e)}"), 502
+    return Response(bulk.iter_ndjson(persons), mimetype='application/x-ndjson')
+
+# Handle bulk person search, results are streamed as NDJSON as soon as each lookup completes
+@app.route('/bulk/search', methods=['POST'])
+def bulk_search():
+    logger.debug("Received POST request to '/bulk/search' route.")
+    try:
+        if 'file' in request.files:
+            # Uploaded CSV file with one search value (UNZR by default) per line
+            text = request.files['file'].read().decode('utf-8-sig')
+            lookups = bulk.parse_lookups_csv(text, request.form.get('field', 'unzr'))
+        elif request.mimetype == 'text/csv':
+            lookups = bulk.parse_lookups_csv(request.get_data(as_text=True), request.args.get('field', 'unzr'))
+        else:
+            lookups = bulk.parse_lookups_json(request.get_json())
+        if len(lookups) > conf.bulk_max_items:
+            raise ValueError(f"Too many lookups: {len(lookups)}, maximum is {conf.bulk_max_items}")
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return jsonify(message=f"Error processing bulk search request: {str(e)}"), 400
+    results = bulk.iter_bulk_search(lookups, conf, conf.bulk_concurrency)
+    return Response(bulk.iter_ndjson(results), mimetype='application/x-ndjson')
+
+# Handle bulk create/edit/delete, body is a JSON array or NDJSON with one person per line
+@app.route('/bulk/<operation>', methods=['POST'])
+def bulk_mutation(operation):
+    logger.debug("Received POST request to '/bulk/%s' route.", operation)
+    if operation not in bulk.MUTATIONS:
+        return jsonify(message=f"Unknown bulk operation: {operation}"), 404
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            items = bulk.parse_items_ndjson(request.get_data(as_text=True))
+        else:
+            items = request.get_json()
+        items = bulk.validate_mutation_items(operation, items)
+        if len(items) > conf.bulk_max_items:
+            raise ValueError(f"Too many items: {len(items)}, maximum is {conf.bulk_max_items}")
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return jsonify(message=f"Error processing bulk {operation} request: {str(e)}"), 400
+    results = bulk.iter_bulk_mutation(operation, items, conf, conf.bulk_concurrency, conf.bulk_rate_limit)
+    return Response(bulk.iter_ndjson(results), mimetype='application/x-ndjson')
+
 # Handle certificate download
 @app.route('/download_cert/<filename>')
 def download_cert(filename):
-    logger.debug(f"Received GET request to '/download_cert/{filename}' route.")
+    logger.debug("Received GET request to '/download_cert/%s' route.", filename)
     CERT_DIR = os.path.join(os.getcwd(), crt_directory)
     safe_filename = os.path.basename(filename)  # File name validation for security
     try:
         return send_from_directory(CERT_DIR, safe_filename, as_attachment=True)  # Send certificate
     except Exception as e:
-        logger.error(f"Error occurred: {str(e)}")
+        logger.error("Error occurred: %s", e)
         return render_template('error.html', error_message=e, current_page='certs')
 
 # Handle certificate list display
 @app.route('/certs')
 def list_certs():
     logger.debug("Received GET request to '/certs' route.")
+    page = request.args.get('page', 1, type=int)
+    size = min(request.args.get('size', conf.files_page_size, type=int), MAX_PAGE_SIZE)
+    if size <= 0:
+        size = MAX_PAGE_SIZE
     try:
-        # Get list of certificates in directory
-        files = []
-        for filename in os.listdir(crt_directory):
-            filepath = os.path.join(crt_directory, filename)
-            if os.path.isfile(filepath):
-                creation_time = datetime.fromtimestamp(os.path.getctime(filepath))
-                files.append({
-                    'name': filename,
-                    'creation_time': creation_time.strftime('%Y-%m-%d %H:%M:%S')
-                })
-
-        # Sort certificates by creation date in descending order
-        files = sorted(files, key=lambda x: x['creation_time'], reverse=True)
+        # Certificates sorted by creation time, newest first; the directory is read again only when it changed
+        index = utils.get_directory_index(crt_directory, conf.files_rescan_interval)
+        pagination = index.page(page, size)
         logger.debug("Certificate list retrieved successfully.")
 
-        return render_template('list_certs.html', files=files, current_page='certs')
+        return render_template('list_certs.html', files=pagination['items'], pagination=pagination,
+                               current_page='certs')
     except Exception as e:
-        logger.error(f"Error occurred: {str(e)}")
+        logger.error("Error occurred: %s", e)
         return render_template('error.html', error_message=e, current_page='certs')
 
+# Handle ASiC container list display
+@app.route('/files')
+def list_files():
+    logger.debug("Received GET request to '/files' route.")
+    page = request.args.get('page', 1, type=int)
+    size = min(request.args.get('size', conf.files_page_size, type=int), MAX_PAGE_SIZE)
+    if size <= 0:
+        size = MAX_PAGE_SIZE
+    try:
+        pagination = utils.get_directory_index(asic_directory, conf.files_rescan_interval).page(page, size)
+        return render_template('list_files.html', files=pagination['items'], pagination=pagination,
+                               current_page='files')
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return render_template('error.html', error_message=e, current_page='files')
+
+# Handle ASiC container download
+@app.route('/download_file/<filename>')
+def download_file(filename):
+    logger.debug("Received GET request to '/download_file/%s' route.", filename)
+    safe_filename = os.path.basename(filename)  # File name validation for security
+    try:
+        return send_from_directory(os.path.join(os.getcwd(), asic_directory), safe_filename, as_attachment=True)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return render_template('error.html', error_message=e, current_page='files')
+
+# Handle request to archive ASiC containers of queries, body is a JSON list of X-Road-Id values
+# (or {"query_ids": [...]}) or plain text with one X-Road-Id per line. Containers are downloaded in background.
+@app.route('/asic', methods=['POST'])
+def archive_asic():
+    logger.debug("Received POST request to '/asic' route.")
+    try:
+        if request.mimetype == 'text/plain':
+            query_ids = [line.strip() for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        else:
+            query_ids = request.get_json()
+            if isinstance(query_ids, dict):
+                query_ids = query_ids.get('query_ids')
+        if not isinstance(query_ids, list) or not all(isinstance(q, str) and 0 < len(q) <= 256 for q in query_ids):
+            raise ValueError("Expected a list of X-Road-Id values")
+        if len(query_ids) > conf.bulk_max_items:
+            raise ValueError(f"Too many queries: {len(query_ids)}, maximum is {conf.bulk_max_items}")
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return jsonify(message=f"Error processing archive request: {str(e)}"), 400
+    queued = utils.get_asic_archiver(conf).submit(query_ids)
+    return jsonify(queued=queued, requested=len(query_ids)), 202
+
+# Handle ASiC container lookup by X-Road-Id: the container when downloaded, otherwise its download state
+@app.route('/asic/<path:query_id>')
+def get_asic(query_id):
+    logger.debug("Received GET request to '/asic/%s' route.", query_id)
+    # Lookups only read the index, downloads are started where containers are requested
+    entry = utils.get_asic_index(conf).get(query_id)
+    if entry is None:
+        return jsonify(message=f"No ASiC container requested for query {query_id}"), 404
+    if entry['status'] == 'done':
+        return send_from_directory(os.path.join(os.getcwd(), asic_directory), entry['filename'], as_attachment=True)
+    status_code = 404 if entry['status'] == 'failed' else 202
+    return jsonify(query_id=query_id, status=entry['status'], attempts=entry['attempts'],
+                   error=entry['error']), status_code
+
+# Handle runtime statistics of the X-Road transport
+@app.route('/stats')
+def stats():
+    logger.debug("Received GET request to '/stats' route.")
+    return jsonify(pool=utils.get_pool_stats(conf),
+                   person_cache=utils.get_cache_stats(conf),
+                   coalescing=utils.get_coalescing_stats(),
+                   resilience=utils.get_resilience_stats(conf),
+                   balancer=utils.get_balancer_stats(conf),
+                   asic=utils.get_asic_stats(conf),
+                   jobs=utils.get_job_stats(conf),
+                   admission=utils.get_admission_stats(conf),
+                   scheduler=utils.get_scheduler_stats(conf))
+
+# Handle metrics scrape in Prometheus text format
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 # Application entry point
 if __name__ == '__main__':
     # Run Flask application in debug mode
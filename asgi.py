@@ -0,0 +1,255 @@
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import render_template
+
+import admission
+import async_client
+import metrics
+import utils
+from app import MAX_PAGE_SIZE, app as flask_app, conf
+
+logger = logging.getLogger(__name__)
+
+# Routes without X-Road calls (certificates, statistics) are served by the Flask application
+wsgi_application = WsgiToAsgi(flask_app)
+
+
+async def read_body(receive) -> bytes:
+    # Read full request body from ASGI messages
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_response(send, status: int, body: bytes, content_type: str, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()),
+                    (b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_html(send, template: str, status: int = 200, headers=(), **context):
+    # Render page with the templates and Bootstrap configuration of the Flask application,
+    # url_for() in templates builds links relative to the server root
+    with flask_app.test_request_context():
+        html = render_template(template, **context)
+    await send_response(send, status, html.encode(), "text/html; charset=utf-8", headers)
+
+
+# Templates of the Flask application rendered as they are iterated, loops may run over asynchronous iterators
+async_templates = flask_app.jinja_env.overlay(enable_async=True)
+
+
+async def send_html_stream(send, template: str, **context):
+    # Same as send_html, the page is sent in parts while it is rendered (like flask.stream_template)
+    with flask_app.test_request_context():
+        flask_app.update_template_context(context)
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/html; charset=utf-8")],
+        })
+        try:
+            async for part in async_templates.get_template(template).generate_async(**context):
+                await send({"type": "http.response.body", "body": part.encode(), "more_body": True})
+        except Exception as e:
+            # The status was already sent, the page ends where the error occurred
+            logger.error("Error occurred while streaming %s: %s", template, e)
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_json(send, status: int, headers=(), **payload):
+    with flask_app.app_context():
+        body = flask_app.json.dumps(payload)
+    await send_response(send, status, body.encode(), "application/json", headers)
+
+
+def int_value(values: dict, name: str, default: int) -> int:
+    # Integer parameter of the request, default if missing or invalid (like request.values.get(type=int))
+    try:
+        return int(values[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+# Handle HTTP requests to the home page
+async def search_user(scope, receive, send):
+    logger.debug("Received %s request to '/' route.", scope['method'])
+    # Search parameters come from the search form (POST) or from pagination links (GET)
+    values = parse_qs(scope.get("query_string", b"").decode())
+    if scope["method"] == "POST":
+        values.update(parse_qs((await read_body(receive)).decode()))
+    search_field = values.get('search_field', [None])[0]
+    search_value = values.get('search_value', [None])[0]
+    if scope["method"] == "POST" or search_field:  # Handle person search
+        logger.debug("Received search parameters: %s : %s", search_field, search_value)
+        page = int_value(values, 'page', 1)
+        size = min(int_value(values, 'size', conf.search_page_size), MAX_PAGE_SIZE)
+
+        try:
+            if conf.search_stream_results == "true":
+                # Rows are sent to the browser while the result is received from the security server
+                data = await async_client.iter_person_from_service(search_field, search_value, conf)
+                return await send_html_stream(send, 'list_person.html', data=data, current_page='index')
+            if size > 0:
+                # Only the requested page is rendered, next pages are loaded by the browser on demand
+                pagination = await async_client.get_person_page(search_field, search_value, page, size, conf,
+                                                                refresh=scope["method"] == 'POST')
+                return await send_html(send, 'list_person.html', data=pagination['items'],
+                                       pagination=pagination, current_page='index')
+            # Query for person information
+            data = await async_client.get_person_from_service(search_field, search_value, conf)
+        except Exception as e:
+            # In case of error, render error page
+            logger.error("Error occurred: %s", e)
+            return await send_html(send, 'error.html', error_message=e, current_page='index')
+        return await send_html(send, 'list_person.html', data=data, current_page='index')
+
+    # If GET request, render the search form
+    return await send_html(send, 'search_form.html', current_page='index')
+
+
+# Handle person creation
+async def create_user(scope, receive, send):
+    logger.debug("Received %s request to '/create' route.", scope['method'])
+    if scope["method"] == "POST":  # Handle POST request to create a new person
+        try:
+            form_data = json.loads(await read_body(receive))  # Read form data
+            logger.debug("Received creation request with parameters: %s", form_data)
+            # Call function to add new person
+            response = await async_client.service_add_person(form_data, conf)
+            return await send_json(send, response.status_code, message=response.body)
+        except Exception as e:
+            logger.debug("Error occurred: %s", e)
+            return await send_json(send, 422, message=f'Error creating person object: {str(e)}')
+
+    # If GET request, render person creation form
+    return await send_html(send, 'create_person.html', current_page='create')
+
+
+# Handle person data editing
+async def edit_user(scope, receive, send):
+    logger.debug("Received POST request to '/edit' route.")
+    try:
+        data = json.loads(await read_body(receive))  # Get edit data
+        logger.debug("Received edit data: %s", data)
+        # Call function to edit person data
+        http_resp = await async_client.edit_person_in_service(data, conf)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return await send_json(send, 500, message=f"Error processing edit request: {str(e)}")
+    return await send_json(send, http_resp.status_code, message=http_resp.body)
+
+
+# Handle person deletion
+async def delete_person(scope, receive, send):
+    logger.debug("Received POST request to '/delete' route.")
+    try:
+        data = json.loads(await read_body(receive))  # Get person data to delete
+        logger.debug("Received deletion request: %s", data)
+        # Call function to delete person
+        http_resp = await async_client.service_delete_person(data, conf)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        return await send_json(send, 500, message=f"Error processing deletion request: {str(e)}")
+    return await send_json(send, http_resp.status_code, message=http_resp.body)
+
+
+routes = {
+    ('/', 'GET'): search_user,
+    ('/', 'POST'): search_user,
+    ('/create', 'GET'): create_user,
+    ('/create', 'POST'): create_user,
+    ('/edit', 'POST'): edit_user,
+    ('/delete', 'POST'): delete_person,
+}
+
+
+def queued_mutation(scope) -> bool:
+    # Mutations requested in asynchronous mode (see app.async_requested) are only written to the job
+    # queue, the Flask route does it without waiting for the security server
+    if scope["method"] != "POST" or scope["path"] not in ('/create', '/edit', '/delete'):
+        return False
+    query = parse_qs(scope.get("query_string", b"").decode())
+    return query.get('async', [conf.jobs_async_mutations])[0] == 'true'
+
+
+async def handle_with_admission(handler, scope, receive, send):
+    # Same admission control as app.admission_controlled; forms (GET without parameters) are not limited
+    limiter = utils.get_admission_limiter(conf)
+    if limiter is None or (scope["method"] == "GET" and not scope.get("query_string")):
+        return await handler(scope, receive, send)
+    try:
+        await limiter.aacquire()
+    except admission.OverloadedError as e:
+        metrics.admission_rejected.inc(route=scope["path"], reason=e.reason)
+        logger.warning("Request to %s rejected: %s", scope["path"], e)
+        headers = [(b"retry-after", str(e.retry_after).encode())]
+        if scope["path"] == '/':
+            return await send_html(send, 'error.html', 503, headers, error_message=e, current_page='index')
+        return await send_json(send, 503, headers, message=str(e))
+    try:
+        await handler(scope, receive, send)
+    finally:
+        limiter.release()
+
+
+async def handle_with_metrics(handler, scope, receive, send):
+    # Same request metrics as the Flask application records for its routes
+    route, method = scope["path"], scope["method"]
+    status = 500
+
+    async def send_with_status(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        await send(message)
+
+    metrics.http_requests_in_flight.inc(route=route)
+    start = time.perf_counter()
+    try:
+        await handle_with_admission(handler, scope, receive, send_with_status)
+    except Exception:
+        metrics.http_request_exceptions.inc(route=route, method=method)
+        raise
+    finally:
+        metrics.http_requests_in_flight.dec(route=route)
+        metrics.http_request_duration.observe(time.perf_counter() - start, route=route, method=method, status=status)
+
+
+async def lifespan(receive, send):
+    # Close connections to the security server when the server process stops
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # Already done on import of the Flask application unless the import was done before fork
+            utils.resume_background_work(conf)
+            logger.info("ASGI application started.")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_client.close_async_xroad_clients()
+            logger.info("ASGI application stopped.")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# ASGI entry point, e.g.: uvicorn asgi:application --host 0.0.0.0 --port 5000
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] == "http":
+        handler = routes.get((scope["path"], scope["method"]))
+        if handler is not None and not queued_mutation(scope):
+            return await handle_with_metrics(handler, scope, receive, send)
+    await wsgi_application(scope, receive, send)
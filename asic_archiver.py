@@ -0,0 +1,253 @@
+import hashlib
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# States of a container in the index
+PENDING = "pending"
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+
+# Characters allowed in container file names, everything else in the query id is replaced
+UNSAFE_FILENAME_CHARACTERS = re.compile(r"[^A-Za-z0-9._-]")
+
+# Responses which are not retried: the container does not exist or the request is not allowed
+PERMANENT_STATUSES = {400, 401, 403, 404}
+
+
+def container_filename(query_id: str) -> str:
+    # Readable part of the query id plus its hash: different query ids never share a file,
+    # even if they differ only in replaced characters, and the name stays within file name limits
+    readable = UNSAFE_FILENAME_CHARACTERS.sub("_", query_id)[:64]
+    return f"{readable}-{hashlib.sha256(query_id.encode()).hexdigest()}.asice"
+
+
+class AsicIndex:
+    # On-disk index of ASiC containers stored in SQLite: query id -> file name, size and download state.
+    # It is shared by all worker processes of the node, a container is claimed by one of them for download.
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS containers ("
+                       "query_id TEXT PRIMARY KEY, host TEXT, status TEXT, filename TEXT, size INTEGER, "
+                       "attempts INTEGER, error TEXT, not_before REAL, owner INTEGER, "
+                       "created_at REAL, updated_at REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS containers_status_not_before ON containers (status, not_before)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, created on first use
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def add(self, query_ids, host: str = None, delay: float = 0.0) -> int:
+        # Queue containers for download after `delay` seconds; failed containers are queued again,
+        # containers already downloaded or queued are left as they are. Returns the number queued.
+        now = time.time()
+        with self._connection() as db:
+            queued = 0
+            for query_id in query_ids:
+                queued += db.execute(
+                    "INSERT INTO containers VALUES (?, ?, ?, ?, 0, 0, NULL, ?, NULL, ?, ?) "
+                    "ON CONFLICT (query_id) DO UPDATE SET status = excluded.status, attempts = 0, error = NULL, "
+                    "not_before = excluded.not_before, updated_at = excluded.updated_at "
+                    "WHERE containers.status = 'failed'",
+                    (query_id, host, PENDING, container_filename(query_id), now + delay, now, now)).rowcount
+        return queued
+
+    def get(self, query_id: str):
+        row = self._connection().execute("SELECT * FROM containers WHERE query_id = ?", (query_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self):
+        # Take the next container due for download, None if there is none
+        db = self._connection()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT * FROM containers WHERE status = ? AND not_before <= ? "
+                             "ORDER BY not_before LIMIT 1", (PENDING, now)).fetchone()
+            if row is not None:
+                db.execute("UPDATE containers SET status = ?, owner = ?, updated_at = ? WHERE query_id = ?",
+                           (DOWNLOADING, os.getpid(), now, row["query_id"]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return dict(row) if row is not None else None
+
+    def mark_done(self, query_id: str, size: int):
+        with self._connection() as db:
+            db.execute("UPDATE containers SET status = ?, size = ?, error = NULL, owner = NULL, updated_at = ? "
+                       "WHERE query_id = ?", (DONE, size, time.time(), query_id))
+
+    def mark_retry(self, query_id: str, attempts: int, error: str, delay: float):
+        now = time.time()
+        with self._connection() as db:
+            db.execute("UPDATE containers SET status = ?, attempts = ?, error = ?, not_before = ?, owner = NULL, "
+                       "updated_at = ? WHERE query_id = ?", (PENDING, attempts, error, now + delay, now, query_id))
+
+    def mark_failed(self, query_id: str, attempts: int, error: str):
+        with self._connection() as db:
+            db.execute("UPDATE containers SET status = ?, attempts = ?, error = ?, owner = NULL, updated_at = ? "
+                       "WHERE query_id = ?", (FAILED, attempts, error, time.time(), query_id))
+
+    def release_abandoned(self, stale_after: float = 3600.0) -> int:
+        # Downloads of processes that exited, or claimed more than stale_after seconds ago (the pid may
+        # belong to another process after restart of a container), are queued again and resumed.
+        # utils imports this module, it is imported here to keep the import order free
+        from utils import process_alive
+        db = self._connection()
+        owners = [row[0] for row in db.execute(
+            "SELECT DISTINCT owner FROM containers WHERE status = ?", (DOWNLOADING,))]
+        released = 0
+        with db:
+            for owner in owners:
+                if owner is None or owner == os.getpid() or not process_alive(owner):
+                    released += db.execute("UPDATE containers SET status = ?, owner = NULL "
+                                           "WHERE status = ? AND owner IS ?", (PENDING, DOWNLOADING, owner)).rowcount
+            released += db.execute("UPDATE containers SET status = ?, owner = NULL "
+                                   "WHERE status = ? AND updated_at < ?",
+                                   (PENDING, DOWNLOADING, time.time() - stale_after)).rowcount
+        return released
+
+    def counts(self) -> dict:
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM containers GROUP BY status")
+        return {status: count for status, count in rows}
+
+
+class AsicArchiver:
+    # Background download of signed ASiC containers of completed X-Road queries from the /signature
+    # endpoint of the security server. `workers` threads download containers in parallel, every
+    # container is streamed to a partial file which is renamed when complete, so memory use does not
+    # depend on container size. Interrupted downloads continue from the partial file with a Range
+    # request; failed attempts are retried with jittered exponential backoff up to max_retries times.
+    def __init__(self, index: AsicIndex, directory: str, get_session, base_uris: list, params: dict,
+                 timeout, workers: int = 4, max_retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, chunk_size: int = 65536, poll_interval: float = 1.0):
+        self.index = index
+        self.directory = directory
+        self.partial_directory = os.path.dirname(index.path)
+        self.get_session = get_session
+        self.base_uris = base_uris
+        self.params = params
+        self.timeout = timeout
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        released = self.index.release_abandoned()
+        if released:
+            logger.info("Resuming %s interrupted ASiC container downloads", released)
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"asic-archiver-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def submit(self, query_ids, host: str = None, delay: float = 0.0) -> int:
+        # Queue containers of the queries for download, host is the security server which handled them
+        queued = self.index.add(query_ids, host, delay)
+        if queued:
+            self._wakeup.set()
+        return queued
+
+    def path(self, entry: dict) -> str:
+        return os.path.join(self.directory, entry["filename"])
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                entry = self.index.claim()
+            except sqlite3.Error as e:
+                logger.error("Reading ASiC container index failed: %s", e)
+                entry = None
+            if entry is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._process(entry)
+
+    def _process(self, entry: dict):
+        query_id = entry["query_id"]
+        attempts = entry["attempts"] + 1
+        try:
+            size = self.download(entry)
+        except Exception as e:
+            permanent = (isinstance(e, requests.HTTPError) and e.response is not None
+                         and e.response.status_code in PERMANENT_STATUSES)
+            if permanent or attempts > self.max_retries:
+                metrics.xroad_asic_downloads.inc(result="failed")
+                logger.error("Downloading ASiC container of query %s failed: %s", query_id, e)
+                self.index.mark_failed(query_id, attempts, str(e))
+            else:
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempts))
+                metrics.xroad_asic_downloads.inc(result="retry")
+                logger.warning("Downloading ASiC container of query %s failed (attempt %s), retrying: %s",
+                               query_id, attempts, e)
+                self.index.mark_retry(query_id, attempts, str(e), delay)
+            return
+        metrics.xroad_asic_downloads.inc(result="ok")
+        self.index.mark_done(query_id, size)
+        logger.info("ASiC container of query %s saved, %s bytes", query_id, size)
+
+    def download(self, entry: dict) -> int:
+        # Stream the container to its partial file and rename it when complete, returns the file size
+        partial = os.path.join(self.partial_directory, entry["filename"] + ".part")
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        params = dict(self.params, queryId=entry["query_id"])
+        # The security server which handled the query first, the message log of a cluster node
+        # may not contain queries of other nodes
+        hosts = [entry["host"]] + [uri for uri in self.base_uris if uri != entry["host"]] \
+            if entry["host"] else self.base_uris
+        session = self.get_session()
+        for number, base_uri in enumerate(hosts):
+            with session.get(base_uri + "/signature", params=params, headers=headers, stream=True,
+                             timeout=self.timeout) as response:
+                if response.status_code == 404 and number < len(hosts) - 1:
+                    continue
+                if response.status_code == 416 and offset:
+                    # Partial file does not match the container any more, download it again
+                    os.remove(partial)
+                    raise requests.HTTPError("Requested range not satisfiable, restarting download",
+                                             response=response)
+                response.raise_for_status()
+                resumed = response.status_code == 206
+                with open(partial, "ab" if resumed else "wb") as file:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        file.write(chunk)
+                        metrics.xroad_asic_downloaded_bytes.inc(len(chunk))
+                    size = file.tell()
+                os.replace(partial, os.path.join(self.directory, entry["filename"]))
+                if resumed:
+                    logger.debug("ASiC container of query %s resumed from byte %s", entry["query_id"], offset)
+                return size
+        raise RuntimeError("No security server configured")
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import time
+import uuid
+from urllib.parse import quote
+
+import httpx
+
+import metrics
+import scheduler
+import utils
+from resilience import CircuitOpenError
+from singleflight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncXRoadClient:
+    # Non-blocking counterpart of utils.XRoadClient used by the ASGI application.
+    # Connections to the security server are kept alive (HTTP/1.1 or HTTP/2) and shared by all coroutines.
+    def __init__(self, config_instance):
+        self.config = config_instance
+        self.ssl_context = None
+        if config_instance.xroad_protocol == "https":
+            self.ssl_context = utils.get_xroad_ssl_context(config_instance)
+        http2 = config_instance.xroad_http2 == "true"
+        self.http = self.create_http(self.ssl_context)
+        # Clients replaced after reload of the TLS material, closed when their requests are complete
+        self.retired_http = set()
+        self.person_path = utils.get_rest_xroad_path(config_instance) + "/person"
+        self.balancer = utils.get_balancer(config_instance)
+        self.query_id_prefix = f"{config_instance.client_instance}-"
+        self.static_headers = utils.get_xroad_headers_from_config(config_instance)
+        del self.static_headers["X-Road-Id"]
+        self.search_flight = AsyncSingleFlight(utils.coalescing_stats)
+        self.resilience = utils.get_resilience_policy(config_instance)
+        self.archive_queries = config_instance.asic_archive_queries == "true"
+        self.admission = utils.get_admission_limiter(config_instance)
+        self.scheduler = utils.get_scheduler(config_instance)
+        utils.watch_tls_material(config_instance)
+        logger.info("Asynchronous X-Road client created, HTTP/2: %s", http2)
+
+    def create_http(self, ssl_context) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            verify=ssl_context if ssl_context is not None else True,
+            http2=self.config.xroad_http2 == "true",
+            timeout=httpx.Timeout(self.config.xroad_read_timeout, connect=self.config.xroad_connect_timeout),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.config.xroad_pool_size),
+        )
+
+    def current_http(self) -> httpx.AsyncClient:
+        # HTTP client using the current TLS material. After the certificates were reloaded a new client
+        # is created, the old one is closed once requests in progress had time to complete.
+        if self.ssl_context is not None:
+            context = utils.get_xroad_ssl_context(self.config)
+            if context is not self.ssl_context:
+                old_http = self.http
+                self.http = self.create_http(context)
+                self.ssl_context = context
+                self.retired_http.add(old_http)
+                grace = self.config.xroad_connect_timeout + self.config.xroad_read_timeout
+                asyncio.get_running_loop().call_later(
+                    grace, lambda: asyncio.ensure_future(self.close_retired(old_http)))
+        return self.http
+
+    async def close_retired(self, http: httpx.AsyncClient):
+        if http in self.retired_http:
+            self.retired_http.discard(http)
+            await http.aclose()
+
+    def new_headers(self) -> dict:
+        # Static headers plus unique X-Road-Id of the query
+        headers = self.static_headers.copy()
+        headers["X-Road-Id"] = self.query_id_prefix + str(uuid.uuid4())
+        return headers
+
+    async def send(self, method: str, path: str, **kwargs) -> httpx.Response:
+        # Send request to one of the security servers without blocking the event loop.
+        # Every attempt waits for the request rate limit.
+        return await self.resilience.acall(
+            method,
+            lambda: self._request(method, path, **kwargs),
+            retry_on=(httpx.TransportError,),
+            before_attempt=self.dispatch if self.scheduler is not None else None)
+
+    async def dispatch(self):
+        # Turn of the request within the request rate limit, awaited only if no token is available now
+        if not self.scheduler.try_dispatch():
+            await self.scheduler.adispatch()
+
+    async def _request(self, method: str, path: str, stream: bool = False, **kwargs) -> httpx.Response:
+        # Single attempt of the request, measured for metrics.
+        # With stream=True the body is not read, the caller reads it and closes the response.
+        operation = metrics.OPERATIONS.get(method, method.lower())
+        node = self.balancer.acquire()
+        metrics.xroad_requests_in_flight.inc(operation=operation)
+        start = time.perf_counter()
+        ok = False
+        streamed = False
+        headers = self.new_headers()
+        try:
+            http = self.current_http()
+            request = http.build_request(method, node.base_uri + path, headers=headers, **kwargs)
+            response = await http.send(request, stream=stream)
+            ok = response.status_code < 500
+            # Latency of a streamed result includes reading its body, it is observed by the reader
+            streamed = stream and response.status_code == 200
+            response.xroad_started = start
+        except Exception as e:
+            metrics.xroad_request_duration.observe(time.perf_counter() - start, operation=operation, status="error")
+            metrics.xroad_request_errors.inc(operation=operation, error=type(e).__name__)
+            raise
+        finally:
+            metrics.xroad_requests_in_flight.dec(operation=operation)
+            self.balancer.release(node, ok)
+            if self.admission is not None and not streamed:
+                self.admission.observe(time.perf_counter() - start, failed=not ok)
+        metrics.xroad_request_duration.observe(time.perf_counter() - start, operation=operation,
+                                               status=response.status_code)
+        if not stream:
+            metrics.xroad_received_bytes.inc(len(response.content), operation=operation)
+        if self.archive_queries and response.status_code < 400:
+            # The index is written in a thread, not in the event loop
+            asyncio.get_running_loop().run_in_executor(
+                None, utils.archive_query, headers["X-Road-Id"], node.base_uri, self.config)
+        return response
+
+    async def get_person(self, parameter: str, value: str) -> list:
+        # Retrieve person information by parameter via X-Road service
+        path = quote(f"{self.person_path}/{parameter}/{value}", safe=':/')
+        logger.info("Retrieving person information with parameter: %s and value: %s", parameter, value)
+        try:
+            response = await self.send("GET", path)
+        except Exception as e:
+            logger.error("Error retrieving person information: %s", e)
+            raise ValueError(f"Error while sending HTTP GET: {e}")
+        return utils.person_list_from_response(response)
+
+    async def iter_persons(self, parameter: str, value: str):
+        # Retrieve person information as an asynchronous iterator, the response body is parsed while it is received
+        path = quote(f"{self.person_path}/{parameter}/{value}", safe=':/')
+        logger.info("Streaming person information with parameter: %s and value: %s", parameter, value)
+        try:
+            response = await self.send("GET", path, stream=True)
+        except Exception as e:
+            logger.error("Error retrieving person information: %s", e)
+            raise ValueError(f"Error while sending HTTP GET: {e}")
+        if response.status_code != 200:
+            try:
+                await response.aread()
+                utils.person_list_from_response(response)
+            finally:
+                await response.aclose()
+        return self._iter_response_persons(response)
+
+    async def _iter_response_persons(self, response: httpx.Response):
+        parser = utils.JsonArrayItemParser()
+        count = 0
+        failed = False
+        try:
+            async for chunk in response.aiter_bytes(65536):
+                metrics.xroad_received_bytes.inc(len(chunk), operation="search")
+                for person in parser.feed(chunk):
+                    count += 1
+                    yield person
+                if parser.done:
+                    break
+            else:
+                for person in parser.close():
+                    count += 1
+                    yield person
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Return connection to the pool even if the client stopped reading
+            await response.aclose()
+            if self.admission is not None:
+                self.admission.observe(time.perf_counter() - response.xroad_started, failed=failed)
+        logger.info("Streamed %s persons", count)
+
+    async def update_person(self, data: dict) -> utils.CustomResponse:
+        # Edit person information via X-Road service
+        logger.debug("Editing person information: %s", data)
+        try:
+            response = await self.send("PUT", self.person_path, json=data)
+        except (httpx.HTTPError, CircuitOpenError, scheduler.RateLimitTimeout) as e:
+            logger.error("Error editing person information: %s", e)
+            raise ValueError(f"Error while sending HTTP PUT: {e}")
+
+        if not response.content:
+            json_body = {"message": "Nothing to display"}
+            logger.info("Edit complete, received empty response.")
+            return utils.CustomResponse(status_code=response.status_code, body=json_body)
+
+        body = response.json()
+        logger.info("Edit complete, received response: %s", body)
+        return utils.CustomResponse(status_code=response.status_code, body=body)
+
+    async def delete_person(self, unzr: str) -> utils.CustomResponse:
+        # Delete person information via X-Road service
+        logger.info("Deleting person with UNZR id: %s", unzr)
+        try:
+            response = await self.send("DELETE", f"{self.person_path}/unzr/{unzr}")
+        except Exception as e:
+            json_body = {"Error while sending HTTP DELETE": f"{e}"}
+            logger.error("Error deleting person: %s", e)
+            return utils.CustomResponse(status_code=500, body=json_body)
+
+        body = response.json()
+        logger.info("Delete complete, received response: %s", body)
+        return utils.CustomResponse(status_code=response.status_code, body=body)
+
+    async def create_person(self, data: dict) -> utils.CustomResponse:
+        # Add a new person via the X-Road service
+        logger.info("Adding new person: %s", data)
+        try:
+            response = await self.send("POST", self.person_path, json=data)
+            if response.status_code > 400:
+                logger.error("An error occurred while adding the person, status code: %s", response.status_code)
+        except Exception as e:
+            json_body = {"Error while sending HTTP POST": f"{e}"}
+            logger.error("Error occurred while adding new person: %s", e)
+            return utils.CustomResponse(status_code=500, body=json_body)
+
+        body = response.json()
+        logger.info("Add request processed successfully, response received: %s", body)
+        return utils.CustomResponse(status_code=response.status_code, body=body)
+
+    async def aclose(self):
+        for http in list(self.retired_http):
+            await self.close_retired(http)
+        await self.http.aclose()
+
+
+# One client per event loop: httpx connections can't be shared between loops
+_async_clients = {}
+
+
+def get_async_xroad_client(config_instance) -> AsyncXRoadClient:
+    # Return asynchronous X-Road client of the running event loop, creating it on first use
+    key = (id(config_instance), id(asyncio.get_running_loop()))
+    client = _async_clients.get(key)
+    if client is None:
+        client = AsyncXRoadClient(config_instance)
+        _async_clients[key] = client
+    return client
+
+
+async def close_async_xroad_clients():
+    # Close clients that belong to the running event loop
+    loop_id = id(asyncio.get_running_loop())
+    for key in [k for k in _async_clients if k[1] == loop_id]:
+        await _async_clients.pop(key).aclose()
+
+
+async def get_person_from_service(parameter: str, value: str, config_instance) -> list:
+    # Retrieve person information by parameter via X-Road service, using cached result if available.
+    # The cache may be on disk (SQLite), it is read and written in a thread, not in the event loop.
+    persons = await asyncio.to_thread(utils.get_cached_person, parameter, value, config_instance)
+    if persons is not None:
+        return persons
+    cache = utils.get_person_cache(config_instance)
+    client = get_async_xroad_client(config_instance)
+    persons = await client.search_flight.do((parameter, value), client.get_person, parameter, value)
+    if cache is not None:
+        await asyncio.to_thread(cache.set, (parameter, value), persons)
+    return persons
+
+
+async def iter_person_from_service(parameter: str, value: str, config_instance):
+    # Same as utils.iter_person_from_service with the asynchronous client, returns an asynchronous iterator
+    persons = await asyncio.to_thread(utils.get_cached_person, parameter, value, config_instance)
+    if persons is not None:
+        return _iter_list(persons)
+    return await get_async_xroad_client(config_instance).iter_persons(parameter, value)
+
+
+async def _iter_list(items: list):
+    for item in items:
+        yield item
+
+
+async def get_person_page(parameter: str, value: str, page: int, size: int, config_instance,
+                          refresh: bool = False) -> dict:
+    # Same as utils.get_person_page with the asynchronous client
+    persons = None
+    result_cache = None
+    if utils.get_person_cache(config_instance) is None:
+        result_cache = utils.get_search_result_cache(config_instance)
+        if not refresh:
+            persons = result_cache.get((parameter, value))
+    if persons is None:
+        persons = await get_person_from_service(parameter, value, config_instance)
+        if result_cache is not None:
+            result_cache.set((parameter, value), persons)
+    return utils.person_page(persons, parameter, value, page, size)
+
+
+async def edit_person_in_service(data: dict, config_instance) -> utils.CustomResponse:
+    # Edit person information via X-Road service.
+    # Cached results are invalidated in a thread like the cache is read (see get_person_from_service).
+    response = await get_async_xroad_client(config_instance).update_person(data)
+    if response.status_code < 400:
+        await asyncio.to_thread(utils.invalidate_cached_person, data, config_instance)
+    return response
+
+
+async def service_delete_person(data: dict, config_instance) -> utils.CustomResponse:
+    # Delete person information via X-Road service
+    response = await get_async_xroad_client(config_instance).delete_person(data['unzr'])
+    if response.status_code < 400:
+        await asyncio.to_thread(utils.invalidate_cached_person, data, config_instance)
+    return response
+
+
+async def service_add_person(data: dict, config_instance) -> utils.CustomResponse:
+    # Add a new person via the X-Road service
+    response = await get_async_xroad_client(config_instance).create_person(data)
+    if response.status_code < 400:
+        await asyncio.to_thread(utils.invalidate_cached_person, data, config_instance)
+    return response
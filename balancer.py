@@ -0,0 +1,126 @@
+import itertools
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("least_outstanding", "round_robin")
+
+
+class Node:
+    # One security server of the cluster
+    def __init__(self, base_uri: str):
+        self.base_uri = base_uri
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.healthy = True
+
+    def available(self, now: float) -> bool:
+        return self.healthy and self.ejected_until <= now
+
+    def as_dict(self, now: float) -> dict:
+        return {
+            "base_uri": self.base_uri,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "healthy": self.healthy,
+            "ejected": self.ejected_until > now,
+        }
+
+
+class Balancer:
+    # Distributes requests across security servers. A node is ejected for eject_time seconds after
+    # eject_failures consecutive failures (passive check) and skipped while the health checker reports
+    # it unhealthy (active check). If no node is available, all nodes are tried rather than failing.
+    def __init__(self, base_uris: list, strategy: str = "least_outstanding", eject_failures: int = 3,
+                 eject_time: float = 30.0):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.nodes = [Node(base_uri) for base_uri in base_uris]
+        self.strategy = strategy
+        self.eject_failures = eject_failures
+        self.eject_time = eject_time
+        self._lock = threading.Lock()
+        self._round_robin = itertools.count()
+
+    def acquire(self) -> Node:
+        # Choose node for the next request, release() must be called when it is complete
+        now = time.monotonic()
+        with self._lock:
+            candidates = [node for node in self.nodes if node.available(now)] or self.nodes
+            if self.strategy == "round_robin":
+                node = candidates[next(self._round_robin) % len(candidates)]
+            else:
+                # Least outstanding requests, ties resolved by the total number of requests
+                node = min(candidates, key=lambda n: (n.outstanding, n.requests))
+            node.outstanding += 1
+            node.requests += 1
+        metrics.xroad_host_requests_in_flight.inc(host=node.base_uri)
+        return node
+
+    def release(self, node: Node, ok: bool):
+        ejected = False
+        with self._lock:
+            node.outstanding -= 1
+            if ok:
+                node.consecutive_failures = 0
+            else:
+                node.failures += 1
+                node.consecutive_failures += 1
+                if node.consecutive_failures >= self.eject_failures and len(self.nodes) > 1:
+                    node.ejected_until = time.monotonic() + self.eject_time
+                    node.consecutive_failures = 0
+                    ejected = True
+        metrics.xroad_host_requests_in_flight.dec(host=node.base_uri)
+        metrics.xroad_host_requests.inc(host=node.base_uri, result="ok" if ok else "failed")
+        if ejected:
+            metrics.xroad_host_ejections.inc(host=node.base_uri)
+            logger.warning("Security server %s ejected for %s seconds after %s consecutive failures",
+                           node.base_uri, self.eject_time, self.eject_failures)
+
+    def set_health(self, node: Node, healthy: bool):
+        with self._lock:
+            changed = node.healthy != healthy
+            node.healthy = healthy
+        metrics.xroad_host_healthy.set(1 if healthy else 0, host=node.base_uri)
+        if changed:
+            logger.warning("Security server %s is %s", node.base_uri, "healthy" if healthy else "unhealthy")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {"strategy": self.strategy, "nodes": [node.as_dict(now) for node in self.nodes]}
+
+
+class HealthChecker:
+    # Background thread calling check(node) -> bool for every node each `interval` seconds
+    def __init__(self, balancer: Balancer, check, interval: float):
+        self.balancer = balancer
+        self.check = check
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="xroad-health-check", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            for node in self.balancer.nodes:
+                try:
+                    healthy = self.check(node)
+                except Exception as e:
+                    logger.debug("Health check of %s failed: %s", node.base_uri, e)
+                    healthy = False
+                self.balancer.set_health(node, healthy)
@@ -0,0 +1,94 @@
+"""Compare concurrent throughput of the synchronous Flask path and the ASGI path.
+
+Both variants serve the search route ('/') against a local stub security server
+which answers every request after a fixed delay, emulating a slow X-Road service.
+Every search has its own value and the person cache is disabled, so no request is
+answered from a cache or coalesced with another one: all of them reach the stub.
+
+    python -m benchmarks.bench_async --requests 300 --concurrency 150 --delay 0.5 --threads 8
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_security_server import StubSecurityServer, write_config  # noqa: E402
+
+def form(variant: str, number: int) -> dict:
+    # Unique search of the request
+    return {"search_field": "surname", "search_value": f"Shevchenko-{variant}-{number}"}
+
+
+def report(name: str, latencies: list, elapsed: float):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<6} requests: {len(latencies):>5}  throughput: {len(latencies) / elapsed:8.1f} req/s  "
+          f"p50: {statistics.median(latencies) * 1000:7.1f} ms  p95: {p95 * 1000:7.1f} ms")
+
+
+def run_sync(flask_app, total: int, threads: int):
+    # Flask under a threaded WSGI server: every in-flight request holds one worker thread
+    client = flask_app.test_client()
+
+    def one_request(number):
+        started = time.perf_counter()
+        response = client.post("/", data=form("sync", number))
+        assert response.status_code == 200
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(one_request, range(total)))
+    report("sync", latencies, time.perf_counter() - started)
+
+
+async def run_async(asgi_app, total: int, concurrency: int):
+    # ASGI application in a single event loop: waiting on the security server holds no thread
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=asgi_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one_request(number):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/", data=form("async", number))
+                assert response.status_code == 200
+                return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one_request(number) for number in range(total)))
+    report("async", latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300, help="number of searches per variant")
+    parser.add_argument("--concurrency", type=int, default=150, help="concurrent searches of the async variant")
+    parser.add_argument("--threads", type=int, default=8, help="worker threads of the sync variant")
+    parser.add_argument("--delay", type=float, default=0.5, help="stub security server response delay, seconds")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="xroad-bench-")
+    write_config(workdir, xroad={"pool_size": max(args.threads, args.concurrency)}, cache={"enabled": "false"})
+    os.chdir(workdir)
+
+    stub = StubSecurityServer(delay=args.delay).start()
+    try:
+        import app
+        import asgi
+        run_sync(app.app, args.requests, args.threads)
+        asyncio.run(run_async(asgi.application, args.requests, args.concurrency))
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
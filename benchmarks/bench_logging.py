@@ -0,0 +1,128 @@
+"""Measure per-request logging overhead of the X-Road service functions.
+
+The first part compares the log statements of one "add person" and one "search"
+request in the old style (f-strings built eagerly, response body parsed again for
+the log line) with the current lazy %-style logging, at INFO level where DEBUG
+statements are disabled.
+
+The second part compares the time a request thread spends on one INFO record when
+the file handler is called directly and when the queue handler ([logging] queue = true)
+hands the record to the background listener thread. --io-delay emulates a slow or
+busy disk by delaying every write of the file handler.
+
+    python -m benchmarks.bench_logging --iterations 20000 --persons 50 --io-delay 0.0005
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import utils  # noqa: E402
+from benchmarks.stub_security_server import make_person  # noqa: E402
+
+logger = logging.getLogger("bench")
+
+HEADERS = {"X-Road-Client": "TEST/GOV/00000001/CLIENT", "X-Road-UserId": "bench", "Content-Type": "application/json"}
+
+
+def eager_request(data: dict, body: bytes, persons: list):
+    # Log statements as they were written before: every message is formatted,
+    # and the response body is parsed a second time only for the log line
+    logger.debug(f"Received creation request with parameters: {data}")
+    logger.debug(f"X-Road headers constructed: {HEADERS}")
+    logger.info(f"Adding new person: {data}")
+    logger.info(f"Add request processed successfully, response received: {json.loads(body)}")
+    result = json.loads(body)
+    logger.debug(f"Received person data: {persons}")
+    return result
+
+
+def lazy_request(data: dict, body: bytes, persons: list):
+    # Current log statements: DEBUG messages are never formatted at INFO level,
+    # the parsed response body is reused for the log line
+    logger.debug("Received creation request with parameters: %s", data)
+    logger.debug("X-Road headers constructed: %s", HEADERS)
+    logger.info("Adding new person: %s", data)
+    result = json.loads(body)
+    logger.info("Add request processed successfully, response received: %s", result)
+    logger.debug("Received person data: %s", persons)
+    return result
+
+
+def measure(fn, iterations: int, *args) -> list:
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name: str, timings: list):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:<28} mean: {statistics.fmean(timings) * 1e6:8.2f} us  "
+          f"p50: {statistics.median(timings) * 1e6:8.2f} us  p99: {p99 * 1e6:8.2f} us")
+
+
+class SlowFileHandler(logging.FileHandler):
+    # File handler whose every write takes at least io_delay seconds
+    io_delay = 0.0
+
+    def emit(self, record):
+        super().emit(record)
+        if self.io_delay:
+            time.sleep(self.io_delay)
+
+
+def configure(directory: str, name: str, queued: bool, io_delay: float = 0.0):
+    # Fresh root logger writing INFO records to a file, optionally behind the queue
+    utils.stop_log_queue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    handler = SlowFileHandler(os.path.join(directory, name))
+    handler.io_delay = io_delay
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    if queued:
+        utils.start_log_queue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000, help="requests per variant")
+    parser.add_argument("--persons", type=int, default=50, help="persons in the logged search result")
+    parser.add_argument("--io-delay", type=float, default=0.0005, help="seconds added to every file write")
+    args = parser.parse_args()
+
+    persons = [make_person(index) for index in range(args.persons)]
+    data = persons[0]
+    body = json.dumps({"message": data}).encode()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Log statements of one request, level INFO, {args.persons} persons in search result")
+        configure(directory, "eager.log", queued=False)
+        report("eager f-strings", measure(eager_request, args.iterations, data, body, persons))
+        configure(directory, "lazy.log", queued=False)
+        report("lazy %-style", measure(lazy_request, args.iterations, data, body, persons))
+
+        print(f"Time of request thread per INFO record, file write delay {args.io_delay * 1000:.2f} ms")
+        configure(directory, "direct.log", queued=False, io_delay=args.io_delay)
+        report("file handler", measure(logger.info, args.iterations, "Adding new person: %s", data))
+        configure(directory, "queued.log", queued=True, io_delay=args.io_delay)
+        report("queue handler", measure(logger.info, args.iterations, "Adding new person: %s", data))
+        utils.stop_log_queue()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Measure cold start of the application and report where import time goes.
+
+Every run starts a fresh interpreter importing the application module (app or asgi)
+with `python -X importtime` in a temporary directory with its own config.ini and
+certificates, the way a new worker or pod starts. Reported are the wall time of the
+whole start, the slowest modules by cumulative import time and the self time of
+every top-level package, so new heavy imports are easy to spot.
+
+    python -m benchmarks.bench_startup --runs 5 --top 15
+    python -m benchmarks.bench_startup --telemetry --module asgi
+
+By default key and certificate are generated beforehand, --generate-certs measures
+a first start which has to generate them.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_security_server import generate_certificates, write_config  # noqa: E402
+
+# Packages imported only on demand, reported as loaded or not after the start
+LAZY_PACKAGES = ("opentelemetry", "cryptography")
+
+
+def parse_importtime(output: str) -> list:
+    # "import time:  self [us] | cumulative | imported package" lines -> [(module, self_us, cumulative_us)]
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        modules.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return modules
+
+
+def start(module: str, directory: str) -> tuple:
+    # One cold start, returns wall time in seconds and the import time report
+    code = f"import sys; sys.path.insert(0, {ROOT!r}); import {module}"
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=directory,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise SystemExit(f"Import of {module} failed:\n{result.stderr[-2000:]}")
+    return elapsed, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", choices=("app", "asgi"), default="app", help="application module to import")
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest modules to list")
+    parser.add_argument("--telemetry", action="store_true", help="start with [open-telemetry] enabled = true")
+    parser.add_argument("--generate-certs", action="store_true",
+                        help="do not create key and certificate beforehand, every start generates them")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="xroad-startup-") as directory:
+        telemetry = {"enabled": "true" if args.telemetry else "false", "endpoint": "http://127.0.0.1:4317"}
+        write_config(directory, **{"open-telemetry": telemetry})
+        cert_path = os.path.join(directory, "certs")
+        timings = []
+        modules = []
+        for _ in range(args.runs):
+            if not args.generate_certs:
+                if not os.path.exists(os.path.join(cert_path, "cert.pem")):
+                    generate_certificates(cert_path)
+            elif os.path.isdir(cert_path):
+                for name in os.listdir(cert_path):
+                    os.remove(os.path.join(cert_path, name))
+            elapsed, modules = start(args.module, directory)
+            timings.append(elapsed)
+
+    print(f"import {args.module}, telemetry {'enabled' if args.telemetry else 'disabled'}, {args.runs} cold starts")
+    print(f"wall time  min: {min(timings) * 1000:8.1f} ms  median: {statistics.median(timings) * 1000:8.1f} ms  "
+          f"max: {max(timings) * 1000:8.1f} ms")
+
+    # Import times of the last run
+    total = sum(self_us for _, self_us, _ in modules)
+    print(f"\nimport time of the last run: {total / 1000:.1f} ms, {len(modules)} modules")
+    print(f"\nslowest {args.top} modules by cumulative time")
+    for name, _, cumulative in sorted(modules, key=lambda item: item[2], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    packages = {}
+    for name, self_us, _ in modules:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    print(f"\nslowest {args.top} top-level packages by self time")
+    for package, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {package}")
+
+    loaded = {package: package in packages for package in LAZY_PACKAGES}
+    print("\non-demand packages: " + ", ".join(f"{package} {'loaded' if is_loaded else 'not loaded'}"
+                                               for package, is_loaded in loaded.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Load test of the person operations against a local stub security server.
+
+A stub security server implementing the X-Road REST paths of the person service is
+started on port 8080 (http) or 8443 (https with mutual TLS, certificates generated with
+utils.generate_key_cert). Requests are sent either through the Flask routes of app.py
+(--target routes) or directly through the utils service functions (--target utils)
+from --concurrency threads, and throughput and latency percentiles are reported.
+
+    python -m benchmarks.load_test --protocol https --target routes --operations search,create \\
+        --requests 2000 --concurrency 16 --delay 0.01 --set cache.enabled=true
+
+Options of config.ini can be changed with --set section.option=value to compare
+pooling, caching and other settings against the same baseline.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_security_server import (StubSecurityServer, create_server_ssl_context,  # noqa: E402
+                                             generate_certificates, make_person, write_config)
+
+OPERATIONS = ("search", "create", "edit", "delete")
+
+# Security server ports used by the client (see utils.get_base_xroad_uri)
+PORTS = {"http": 8080, "https": 8443}
+
+
+def percentile(latencies: list, share: float) -> float:
+    # Nearest-rank percentile of sorted latencies
+    index = max(0, min(len(latencies) - 1, int(round(share * len(latencies))) - 1))
+    return latencies[index]
+
+
+def report(name: str, latencies: list, errors: int, elapsed: float):
+    latencies = sorted(latencies)
+    print(f"{name:<8} requests: {len(latencies):>6}  errors: {errors:>5}  "
+          f"throughput: {len(latencies) / elapsed:8.1f} req/s  "
+          f"p50: {statistics.median(latencies) * 1000:7.2f} ms  "
+          f"p95: {percentile(latencies, 0.95) * 1000:7.2f} ms  "
+          f"p99: {percentile(latencies, 0.99) * 1000:7.2f} ms  "
+          f"max: {latencies[-1] * 1000:7.2f} ms")
+
+
+def route_requests(flask_app):
+    # One request of every operation through the Flask routes, returns True on success
+    client = flask_app.test_client()
+
+    def search(index: int, value: str) -> bool:
+        response = client.post("/", data={"search_field": "surname", "search_value": value, "size": "0"})
+        return response.status_code == 200 and b"error" not in response.data[:2000].lower()
+
+    def create(index: int, value: str) -> bool:
+        return client.post("/create", json=make_person(index)).status_code < 400
+
+    def edit(index: int, value: str) -> bool:
+        return client.post("/edit", json=make_person(index)).status_code < 400
+
+    def delete(index: int, value: str) -> bool:
+        return client.post("/delete", json={"unzr": make_person(index)["unzr"]}).status_code < 400
+
+    return {"search": search, "create": create, "edit": edit, "delete": delete}
+
+
+def utils_requests(conf):
+    # One call of every operation through the utils service functions, returns True on success
+    import utils
+
+    def search(index: int, value: str) -> bool:
+        return isinstance(utils.get_person_from_service("surname", value, conf), list)
+
+    def create(index: int, value: str) -> bool:
+        return utils.service_add_person(make_person(index), conf).status_code < 400
+
+    def edit(index: int, value: str) -> bool:
+        return utils.edit_person_in_service(make_person(index), conf).status_code < 400
+
+    def delete(index: int, value: str) -> bool:
+        return utils.service_delete_person({"unzr": make_person(index)["unzr"]}, conf).status_code < 400
+
+    return {"search": search, "create": create, "edit": edit, "delete": delete}
+
+
+def run(name: str, operation, total: int, concurrency: int, distinct: int):
+    # Send `total` requests from `concurrency` threads; searches cycle through `distinct` values
+    def one_request(index: int):
+        started = time.perf_counter()
+        try:
+            ok = operation(index, f"Surname{index % distinct}")
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one_request, range(total)))
+    elapsed = time.perf_counter() - started
+    report(name, [latency for latency, _ in results], sum(1 for _, ok in results if not ok), elapsed)
+
+
+def parse_settings(settings: list) -> dict:
+    # ["cache.enabled=true", ...] -> {"cache": {"enabled": "true"}, ...}
+    sections = {}
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        section, _, option = key.partition(".")
+        if not option:
+            raise SystemExit(f"Invalid --set value: {setting}, expected section.option=value")
+        sections.setdefault(section, {})[option] = value
+    return sections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--protocol", choices=PORTS, default="http", help="http or https with mutual TLS")
+    parser.add_argument("--target", choices=("routes", "utils"), default="routes",
+                        help="Flask routes of app.py or utils service functions")
+    parser.add_argument("--operations", default="search", help=f"comma-separated list of {', '.join(OPERATIONS)}")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per operation")
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--delay", type=float, default=0.0, help="stub security server response delay, seconds")
+    parser.add_argument("--persons", type=int, default=10, help="persons in every search result")
+    parser.add_argument("--distinct", type=int, default=1000, help="number of distinct search values")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.OPTION=VALUE",
+                        help="override config.ini option, may be repeated")
+    args = parser.parse_args()
+
+    operations = [operation.strip() for operation in args.operations.split(",") if operation.strip()]
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Unknown operations: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="xroad-load-")
+    cert_path = os.path.join(workdir, "certs")
+    ssl_context = None
+    if args.protocol == "https":
+        generate_certificates(cert_path)
+        ssl_context = create_server_ssl_context(cert_path)
+    sections = parse_settings(args.set)
+    sections.setdefault("xroad", {}).setdefault("pool_size", args.concurrency)
+    sections["xroad"]["cert_path"] = cert_path
+    write_config(workdir, args.protocol, "localhost" if args.protocol == "https" else "127.0.0.1", **sections)
+    os.chdir(workdir)
+
+    stub = StubSecurityServer(port=PORTS[args.protocol], delay=args.delay, persons=args.persons,
+                              ssl_context=ssl_context).start()
+    try:
+        import utils
+        if args.target == "routes":
+            import app
+            conf = app.conf
+            requests_by_operation = route_requests(app.app)
+        else:
+            conf = utils.Config("config.ini")
+            requests_by_operation = utils_requests(conf)
+
+        print(f"{args.target} over {args.protocol}, {args.concurrency} threads, "
+              f"stub delay {args.delay * 1000:.1f} ms, {args.persons} persons per search")
+        for operation in operations:
+            run(operation, requests_by_operation[operation], args.requests, args.concurrency, args.distinct)
+        print(f"pool: {utils.get_pool_stats(conf)}  cache: {utils.get_cache_stats(conf)}")
+    finally:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
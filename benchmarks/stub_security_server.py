@@ -0,0 +1,171 @@
+import json
+import os
+import re
+import ssl
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+import utils
+
+# REST path of the person service published via X-Road: /r1/{instance}/{class}/{code}/{sub}/{service}/person
+PERSON_PATH = re.compile(r"^/r1/[^/]+/[^/]+/[^/]+/[^/]+/[^/]+/person(?:/(?P<field>[^/]+)/(?P<value>[^/?]+))?/?(?:\?.*)?$")
+
+
+def make_person(index: int, field: str = None, value: str = None) -> dict:
+    person = {
+        "id": index,
+        "name": f"Name{index}",
+        "surname": f"Surname{index}",
+        "patronym": f"Patronym{index}",
+        "dateOfBirth": "1990-01-01",
+        "gender": "male",
+        "rnokpp": f"{1000000000 + index}",
+        "passportNumber": f"AB{100000 + index}",
+        "unzr": f"19900101-{10000 + index:05d}",
+    }
+    if field in person:
+        person[field] = value
+    return person
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # Emulates the person service behind an X-Road security server
+    protocol_version = "HTTP/1.1"
+    server_version = "StubSecurityServer"
+    # Headers and body are written separately, avoid delayed ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_person(self, method: str):
+        match = PERSON_PATH.match(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        request_body = self.rfile.read(length) if length else b""
+        if match is None or "X-Road-Client" not in self.headers:
+            return self.send_json(404, {"message": f"Unknown service path: {self.path}"})
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        field, value = match.group("field"), match.group("value")
+        if method == "GET" and field:
+            persons = [make_person(i, field, value) for i in range(self.server.persons)]
+            return self.send_json(200, {"message": persons})
+        if method == "DELETE" and field == "unzr":
+            return self.send_json(200, {"message": f"Person {value} deleted"})
+        if method in ("POST", "PUT") and not field:
+            person = json.loads(request_body or b"{}")
+            status = 201 if method == "POST" else 200
+            return self.send_json(status, {"message": person})
+        return self.send_json(405, {"message": f"Method {method} is not supported for {self.path}"})
+
+    def handle_signature(self):
+        # ASiC container of a query: deterministic content derived from the query id, Range requests supported
+        query = parse_qs(urlsplit(self.path).query)
+        query_id = query.get("queryId", [""])[0]
+        if not query_id or query_id.startswith("missing"):
+            return self.send_json(404, {"message": f"Query {query_id} not found in message log"})
+        pattern = (query_id + "\n").encode()
+        body = (pattern * (self.server.asic_size // len(pattern) + 1))[:self.server.asic_size]
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(body):
+                return self.send_json(416, {"message": "Requested range not satisfiable"})
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", "application/vnd.etsi.asic-e+zip")
+        self.send_header("Content-Disposition", f'attachment; filename="{query_id}.asice"')
+        self.send_header("Content-Length", str(len(body) - start))
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def do_GET(self):
+        if self.path.startswith("/signature"):
+            return self.handle_signature()
+        self.handle_person("GET")
+
+    def do_POST(self):
+        self.handle_person("POST")
+
+    def do_PUT(self):
+        self.handle_person("PUT")
+
+    def do_DELETE(self):
+        self.handle_person("DELETE")
+
+
+class StubSecurityServer:
+    # Local security server stand-in running in a background thread.
+    # With ssl_context it requires TLS with client certificate (mTLS), like a real security server.
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080, delay: float = 0.0, persons: int = 10,
+                 ssl_context: ssl.SSLContext = None, asic_size: int = 65536):
+        ThreadingHTTPServer.request_queue_size = 1024
+        self.httpd = ThreadingHTTPServer((host, port), StubRequestHandler)
+        if ssl_context is not None:
+            # Handshake is done by the handler thread on first read, not by the accepting thread
+            self.httpd.socket = ssl_context.wrap_socket(self.httpd.socket, server_side=True,
+                                                        do_handshake_on_connect=False)
+        self.httpd.daemon_threads = True
+        self.httpd.delay = delay
+        self.httpd.persons = persons
+        self.httpd.asic_size = asic_size
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def generate_certificates(cert_path: str):
+    # Client certificate of the application (cert.pem, key.pem) and security server certificate
+    # (xroad.pem, xroad.key) issued for localhost, both generated like the application does it
+    os.makedirs(cert_path, exist_ok=True)
+    utils.generate_key_cert("key.pem", "cert.pem", cert_path)
+    utils.generate_key_cert("xroad.key", "xroad.pem", cert_path, hostname="localhost")
+
+
+def create_server_ssl_context(cert_path: str) -> ssl.SSLContext:
+    # Security server side of mTLS: own certificate, only the application certificate is accepted
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.path.join(cert_path, "xroad.pem"), os.path.join(cert_path, "xroad.key"))
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(os.path.join(cert_path, "cert.pem"))
+    return context
+
+
+def write_config(directory: str, protocol: str = "http", host: str = "127.0.0.1", **sections) -> str:
+    # Write config.ini pointing the client to the stub security server
+    config = {
+        "xroad": {"protocol": protocol, "host": host, "cert_path": "certs", "asic_path": "asic"},
+        "client": {"instance": "TEST", "memberClass": "GOV", "memberCode": "00000001", "subsystemCode": "CLIENT"},
+        "service": {"instance": "TEST", "memberClass": "GOV", "memberCode": "00000002",
+                    "subsystemCode": "SERVICE", "serviceCode": "person-service"},
+        "logging": {"filename": "", "level": "WARNING"},
+    }
+    for section, options in sections.items():
+        config.setdefault(section, {}).update(options)
+    path = os.path.join(directory, "config.ini")
+    with open(path, "w") as f:
+        for section, options in config.items():
+            f.write(f"[{section}]\n")
+            for option, value in options.items():
+                f.write(f"{option} = {value}\n")
+            f.write("\n")
+    return path
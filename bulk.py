@@ -0,0 +1,163 @@
+import csv
+import io
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import scheduler
+import utils
+from throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Fields of the person service that can be used for searching (see search_form.html)
+SEARCH_FIELDS = ('name', 'surname', 'patronym', 'dateOfBirth', 'passportNumber', 'unzr', 'rnokpp')
+
+
+def parse_lookups_json(payload) -> list:
+    # Accepts [{"field": ..., "value": ...}, ...], [[field, value], ...] or {"lookups": [...]}
+    if isinstance(payload, dict):
+        payload = payload.get('lookups')
+    if not isinstance(payload, list):
+        raise ValueError("Expected a list of lookups")
+    lookups = []
+    for item in payload:
+        if isinstance(item, dict):
+            field, value = item.get('field'), item.get('value')
+        elif isinstance(item, (list, tuple)) and len(item) == 2:
+            field, value = item
+        else:
+            raise ValueError(f"Invalid lookup: {item}")
+        lookups.append(validate_lookup(field, value))
+    return lookups
+
+
+def parse_lookups_csv(text: str, field: str = 'unzr') -> list:
+    # One value per line (first column), an optional header line equal to the field name is skipped
+    lookups = []
+    for row in csv.reader(io.StringIO(text)):
+        if not row or not row[0].strip():
+            continue
+        value = row[0].strip()
+        if not lookups and value == field:
+            continue
+        lookups.append(validate_lookup(field, value))
+    return lookups
+
+
+def validate_lookup(field, value) -> tuple:
+    if field not in SEARCH_FIELDS:
+        raise ValueError(f"Unsupported search field: {field}")
+    if value is None or str(value) == '':
+        raise ValueError(f"Empty search value for field: {field}")
+    return field, str(value)
+
+
+def parse_items_ndjson(text: str) -> list:
+    # One JSON object per line, empty lines are skipped
+    items = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON on line {number}: {e}")
+    return items
+
+
+def validate_mutation_items(operation: str, items) -> list:
+    if not isinstance(items, list):
+        raise ValueError("Expected a list of persons")
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"Item {index} is not a JSON object")
+        if operation in ('edit', 'delete') and not item.get('unzr'):
+            raise ValueError(f"Item {index} has no unzr")
+    return items
+
+
+def iter_parallel(fn, items, concurrency: int, limiter: TokenBucket = None):
+    # Call fn(index, item) for all items in parallel, yielding results in completion order.
+    # At most `concurrency` calls are in flight, so memory does not grow with the list size.
+    # Requests to the security server are sent with bulk priority, after interactive ones.
+    pending_items = iter(enumerate(items))
+
+    def call(index, item):
+        with scheduler.priority(scheduler.BULK):
+            return fn(index, item)
+
+    def submit(executor, index, item):
+        if limiter is not None:
+            limiter.acquire()
+        return executor.submit(call, index, item)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk") as executor:
+        in_flight = set()
+        for index, item in pending_items:
+            in_flight.add(submit(executor, index, item))
+            if len(in_flight) >= concurrency:
+                break
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                next_item = next(pending_items, None)
+                if next_item is not None:
+                    in_flight.add(submit(executor, *next_item))
+
+
+def iter_bulk_search(lookups: list, config_instance, concurrency: int):
+    # Run lookups in parallel, yielding results in completion order
+    def lookup(index: int, item: tuple) -> dict:
+        field, value = item
+        try:
+            persons = utils.get_person_from_service(field, value, config_instance)
+            return {"index": index, "field": field, "value": value, "status": "ok", "persons": persons}
+        except Exception as e:
+            return {"index": index, "field": field, "value": value, "status": "error", "error": str(e)}
+
+    logger.info("Bulk search of %s lookups with concurrency %s", len(lookups), concurrency)
+    yield from iter_parallel(lookup, lookups, concurrency)
+    logger.info("Bulk search complete")
+
+
+# Service functions used by bulk mutations
+MUTATIONS = {
+    'create': utils.service_add_person,
+    'edit': utils.edit_person_in_service,
+    'delete': utils.service_delete_person,
+}
+
+
+def iter_bulk_mutation(operation: str, items: list, config_instance, concurrency: int, rate_limit: float = 0):
+    # Apply create/edit/delete to every item in parallel, yielding per-item results in completion
+    # order followed by a summary. rate_limit caps requests per second (0 - unlimited).
+    service_function = MUTATIONS[operation]
+    limiter = TokenBucket(rate_limit, burst=concurrency) if rate_limit > 0 else None
+
+    def mutate(index: int, item: dict) -> dict:
+        try:
+            response = service_function(item, config_instance)
+            status = "ok" if response.status_code < 400 else "error"
+            return {"index": index, "unzr": item.get('unzr'), "status": status,
+                    "status_code": response.status_code, "message": response.body}
+        except Exception as e:
+            return {"index": index, "unzr": item.get('unzr'), "status": "error", "error": str(e)}
+
+    logger.info("Bulk %s of %s persons with concurrency %s, rate limit %s/s", operation, len(items), concurrency, rate_limit)
+    succeeded = failed = 0
+    for result in iter_parallel(mutate, items, concurrency, limiter):
+        if result["status"] == "ok":
+            succeeded += 1
+        else:
+            failed += 1
+        yield result
+    logger.info("Bulk %s complete: %s succeeded, %s failed", operation, succeeded, failed)
+    yield {"summary": {"operation": operation, "total": len(items), "succeeded": succeeded, "failed": failed}}
+
+
+def iter_ndjson(results):
+    # Serialize results as newline-delimited JSON
+    for result in results:
+        yield json.dumps(result, ensure_ascii=False) + "\n"
@@ -0,0 +1,343 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def deep_getsizeof(obj) -> int:
+    # Approximate memory used by JSON-like object (dicts, lists and scalars)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_getsizeof(k) + deep_getsizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_getsizeof(item) for item in obj)
+    return size
+
+
+class CacheBackend:
+    # Storage of person search results keyed by (search_field, search_value).
+    # Entries expire after ttl seconds and are dropped when a matching person is changed.
+    # Expired entries are kept for further max_stale seconds and returned by lookup() as stale.
+    def lookup(self, key: tuple):
+        # (persons, stale) or None if there is no entry
+        raise NotImplementedError
+
+    def get(self, key: tuple):
+        # Persons of a fresh entry only
+        entry = self.lookup(key)
+        if entry is None or entry[1]:
+            return None
+        return entry[0]
+
+    def set(self, key: tuple, persons: list):
+        raise NotImplementedError
+
+    def invalidate_person(self, person: dict):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    # In-process LRU cache, every worker process keeps its own copy
+    def __init__(self, max_entries: int, ttl: float, max_stale: float = 0.0, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, persons, size)
+        self._keys_by_unzr = {}  # unzr -> keys of entries containing this person
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.memory_bytes = 0
+
+    def lookup(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            now = time.monotonic()
+            if entry[0] + self.max_stale < now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            stale = entry[0] < now
+            if stale:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return entry[1], stale
+
+    def set(self, key: tuple, persons: list):
+        size = deep_getsizeof(key) + deep_getsizeof(persons)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, persons, size)
+            self.memory_bytes += size
+            for person in persons:
+                self._keys_by_unzr.setdefault(person.get('unzr'), set()).add(key)
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes and self.memory_bytes > self.max_bytes and len(self._entries) > 1):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_person(self, person: dict):
+        # Drop entries containing the person and entries whose search matches any of its fields
+        with self._lock:
+            keys = set(self._keys_by_unzr.get(person.get('unzr'), ()))
+            keys.update(key for key in self._entries if person.get(key[0]) == key[1])
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+        if keys:
+            logger.debug("Invalidated %s cached searches for UNZR %s", len(keys), person.get('unzr'))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_unzr.clear()
+            self.memory_bytes = 0
+
+    def _remove(self, key: tuple):
+        _, persons, size = self._entries.pop(key)
+        self.memory_bytes -= size
+        for person in persons:
+            keys = self._keys_by_unzr.get(person.get('unzr'))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_unzr[person.get('unzr')]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "max_stale": self.max_stale,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "memory_bytes": self.memory_bytes,
+            }
+
+
+def default_shared_cache_path() -> str:
+    # Shared memory file system if available, so the cache never touches the disk
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "x-road_rest_client_example-cache.sqlite")
+
+
+class SharedCacheBackend(CacheBackend):
+    # Cache shared by all worker processes of the node, stored in an SQLite database.
+    # Invalidations done by one worker are seen by all others on their next lookup.
+    # When the cache is full the oldest stored entries are evicted first.
+    # With durable=True (disk backend) the file is synced to disk, so the cache survives restarts.
+    def __init__(self, path: str, max_entries: int, ttl: float, max_stale: float = 0.0, max_bytes: int = 0,
+                 durable: bool = False):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_bytes = max_bytes
+        self.durable = durable
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                       "key TEXT PRIMARY KEY, field TEXT, value TEXT, persons TEXT, "
+                       "stored_at REAL, expires_at REAL, size INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS entry_persons (unzr TEXT, key TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS entry_persons_unzr ON entry_persons (unzr)")
+            db.execute("CREATE INDEX IF NOT EXISTS entry_persons_key ON entry_persons (key)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_field_value ON entries (field, value)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_stored_at ON entries (stored_at)")
+        logger.info("%s person cache opened: %s", "Disk" if durable else "Shared", path)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, created on first use
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode NORMAL keeps the database consistent after a crash of the machine
+            db.execute("PRAGMA synchronous=NORMAL" if self.durable else "PRAGMA synchronous=OFF")
+            self._local.db = db
+        return db
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    @staticmethod
+    def _key(key: tuple) -> str:
+        return json.dumps(key)
+
+    def lookup(self, key: tuple):
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT persons, expires_at FROM entries WHERE key = ? AND expires_at >= ?",
+            (self._key(key), now - self.max_stale)).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        stale = row[1] < now
+        self._count("stale_hits" if stale else "hits")
+        return json.loads(row[0]), stale
+
+    def set(self, key: tuple, persons: list):
+        db_key = self._key(key)
+        payload = json.dumps(persons)
+        now = time.time()
+        with self._connection() as db:
+            db.execute("DELETE FROM entry_persons WHERE key = ?", (db_key,))
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (db_key, key[0], key[1], payload, now, now + self.ttl, len(payload)))
+            db.executemany("INSERT INTO entry_persons VALUES (?, ?)",
+                           [(person.get('unzr'), db_key) for person in persons])
+            # Entries too stale to be served are removed first, then the oldest ones above the limits
+            removed = db.execute("DELETE FROM entries WHERE expires_at < ?", (now - self.max_stale,)).rowcount
+            excess = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+            if excess > 0:
+                removed += db.execute("DELETE FROM entries WHERE key IN "
+                                      "(SELECT key FROM entries ORDER BY stored_at LIMIT ?)", (excess,)).rowcount
+                self._count("evictions", excess)
+            if self.max_bytes and db.execute("SELECT SUM(size) FROM entries").fetchone()[0] > self.max_bytes:
+                # Newest entries are kept as long as their total size is within max_bytes
+                evicted = db.execute("DELETE FROM entries WHERE key IN (SELECT key FROM ("
+                                     "SELECT key, SUM(size) OVER (ORDER BY stored_at DESC, key) AS total "
+                                     "FROM entries) WHERE total > ? AND key != ?)",
+                                     (self.max_bytes, db_key)).rowcount
+                removed += evicted
+                self._count("evictions", evicted)
+            if removed:
+                db.execute("DELETE FROM entry_persons WHERE key NOT IN (SELECT key FROM entries)")
+
+    def invalidate_person(self, person: dict):
+        # Drop entries containing the person and entries whose search matches any of its fields
+        conditions = [(field, str(value)) for field, value in person.items() if value is not None]
+        with self._connection() as db:
+            keys = {row[0] for row in db.execute(
+                "SELECT key FROM entry_persons WHERE unzr = ?", (person.get('unzr'),))}
+            for field, value in conditions:
+                keys.update(row[0] for row in db.execute(
+                    "SELECT key FROM entries WHERE field = ? AND value = ?", (field, value)))
+            db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+            db.executemany("DELETE FROM entry_persons WHERE key = ?", [(key,) for key in keys])
+        self._count("invalidations", len(keys))
+        if keys:
+            logger.debug("Invalidated %s cached searches for UNZR %s", len(keys), person.get('unzr'))
+
+    def clear(self):
+        with self._connection() as db:
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM entry_persons")
+
+    def stats(self) -> dict:
+        entries, memory_bytes = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "backend": "disk" if self.durable else "shared",
+                "path": self.path,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "max_stale": self.max_stale,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "memory_bytes": memory_bytes,
+            }
+
+
+def create_cache_backend(config_instance) -> CacheBackend:
+    # Build cache backend selected in the [cache] section
+    limits = (config_instance.cache_max_entries, config_instance.cache_ttl,
+              config_instance.cache_max_stale, config_instance.cache_max_bytes)
+    if config_instance.cache_backend == "shared":
+        path = config_instance.cache_shared_path or default_shared_cache_path()
+        return SharedCacheBackend(path, *limits)
+    if config_instance.cache_backend == "disk":
+        return SharedCacheBackend(config_instance.cache_disk_path, *limits, durable=True)
+    if config_instance.cache_backend == "memory":
+        return MemoryCacheBackend(*limits)
+    raise ValueError(f"Unknown cache backend: {config_instance.cache_backend}")
+
+
+class CacheRefresher:
+    # Refreshes stale cache entries in `workers` background threads. A key is refreshed by one
+    # thread at a time, lookups of a key already being refreshed don't queue it again.
+    def __init__(self, workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cache-refresh")
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.refreshes = 0
+        self.failures = 0
+
+    def submit(self, key: tuple, refresh) -> bool:
+        # Call refresh() in the background unless the key is already queued, returns True if queued
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+        self._executor.submit(self._refresh, key, refresh)
+        return True
+
+    def _refresh(self, key: tuple, refresh):
+        try:
+            refresh()
+        except Exception as e:
+            # The stale entry is served until max_stale runs out, e.g. during a security server outage
+            logger.warning("Refreshing cached search %s failed: %s", key, e)
+            with self._lock:
+                self.failures += 1
+        else:
+            with self._lock:
+                self.refreshes += 1
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"refreshes": self.refreshes, "refresh_failures": self.failures,
+                    "refreshing": len(self._pending)}
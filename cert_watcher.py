@@ -0,0 +1,60 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def file_versions(paths) -> tuple:
+    # Modification time and size of every file, None for a missing file
+    versions = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            versions.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            versions.append(None)
+    return tuple(versions)
+
+
+class CertificateWatcher:
+    # Background thread checking certificate and key files every `interval` seconds and calling
+    # reload() when any of them changed since `versions`. If reload() fails (for example the key was
+    # replaced but the certificate not yet), the old material stays in use until the files change again.
+    def __init__(self, paths, reload, interval: float, versions: tuple = None):
+        self.paths = list(paths)
+        self.reload = reload
+        self.interval = interval
+        self.versions = versions if versions is not None else file_versions(self.paths)
+        self.failed_versions = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="xroad-cert-watcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def check(self) -> bool:
+        # Reload if files changed, returns True if new material was loaded
+        versions = file_versions(self.paths)
+        if versions == self.versions or versions == self.failed_versions:
+            return False
+        if None in versions:
+            logger.warning("Certificate files are incomplete, keeping loaded certificates: %s", self.paths)
+            self.failed_versions = versions
+            return False
+        try:
+            self.reload()
+        except Exception as e:
+            logger.error("Reloading certificates failed, keeping loaded certificates: %s", e)
+            self.failed_versions = versions
+            return False
+        self.versions = versions
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
@@ -0,0 +1,90 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryIndex:
+    # Metadata of the files of a directory kept in memory, newest first. Adding, removing or renaming
+    # a file changes the modification time of the directory: then the names are read again with
+    # scandir and only new files are stat'ed. Files replaced in place don't change the directory,
+    # so the whole index is rebuilt every rescan_interval seconds (0 - only on directory changes).
+    def __init__(self, directory: str, rescan_interval: float = 60.0):
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._files = {}  # name -> metadata
+        self._sorted = []
+        self._directory_mtime = None
+        self._scanned_at = 0.0
+        self.scans = 0
+
+    def entries(self) -> list:
+        # Files sorted by creation time, newest first
+        self.refresh()
+        return self._sorted
+
+    def page(self, page: int, size: int) -> dict:
+        # One page of the file list with the same fields as a page of search results
+        files = self.entries()
+        total = len(files)
+        pages = max(1, -(-total // size))
+        page = min(max(page, 1), pages)
+        return {
+            "page": page,
+            "size": size,
+            "total": total,
+            "pages": pages,
+            "items": files[(page - 1) * size:page * size],
+        }
+
+    def refresh(self):
+        # Update the index if the directory changed or the full rescan is due
+        if self._changes() is None:
+            return
+        with self._lock:
+            changes = self._changes()
+            if changes is not None:
+                directory_mtime, full = changes
+                self._scan(full)
+                self._directory_mtime = directory_mtime
+
+    def _changes(self):
+        # None if the index is up to date, otherwise (directory modification time, full rescan needed)
+        directory_mtime = os.stat(self.directory).st_mtime_ns
+        full = self._directory_mtime is None or (
+            self.rescan_interval > 0 and time.monotonic() - self._scanned_at >= self.rescan_interval)
+        if directory_mtime == self._directory_mtime and not full:
+            return None
+        return directory_mtime, full
+
+    def _scan(self, full: bool):
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                known = None if full else self._files.get(entry.name)
+                if known is not None:
+                    files[entry.name] = known
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    # Removed while scanning
+                    continue
+                files[entry.name] = {
+                    "name": entry.name,
+                    "size": stat.st_size,
+                    "created": stat.st_ctime,
+                    "creation_time": datetime.datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
+                }
+        self._files = files
+        self._sorted = sorted(files.values(), key=lambda item: (item["created"], item["name"]), reverse=True)
+        if full:
+            self._scanned_at = time.monotonic()
+        self.scans += 1
+        logger.debug("Directory %s indexed, %s files", self.directory, len(files))
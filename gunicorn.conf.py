@@ -0,0 +1,82 @@
+# Production server configuration, used by: gunicorn --config gunicorn.conf.py
+# Settings are read from the [server] section of config.ini (or SERVER_* environment variables).
+import math
+import os
+
+import log_utils
+import utils
+
+conf = utils.Config('config.ini')
+
+
+def available_cpus() -> int:
+    # CPUs the process may use: CPU affinity and the cgroup quota of the container
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(cpus, 1)
+
+
+bind = conf.server_bind
+preload_app = conf.server_preload == "true"
+# The master process imports the application, background work is resumed by the workers (post_fork)
+utils.defer_background_work = preload_app
+timeout = conf.server_timeout
+graceful_timeout = conf.server_graceful_timeout
+keepalive = conf.server_keepalive
+max_requests = conf.server_max_requests
+max_requests_jitter = conf.server_max_requests_jitter
+
+if conf.server_mode == "asgi":
+    # One event loop per worker, waiting for the security server does not hold a thread
+    wsgi_app = "asgi:application"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    workers = conf.server_workers or available_cpus()
+elif conf.server_mode == "wsgi":
+    # Requests mostly wait for the security server, so every worker serves as many requests
+    # in parallel as it keeps pooled connections
+    wsgi_app = "app:app"
+    worker_class = "gthread"
+    workers = conf.server_workers or 2 * available_cpus() + 1
+    threads = conf.server_threads or conf.xroad_pool_size
+else:
+    raise ValueError(f"Unknown server mode: {conf.server_mode}")
+
+if workers > 1 and conf.log_filename and conf.log_rotation in log_utils.PROCESS_ROTATIONS:
+    # Every worker would rename the shared log file on its own, records of the others get lost
+    raise ValueError(f"Log rotation '{conf.log_rotation}' works with a single worker process only, "
+                     f"use rotation = external with logrotate or server workers = 1")
+
+
+def when_ready(server):
+    # With preload the application is imported once by the master process: configuration,
+    # certificates and telemetry are set up before forking. TLS material is loaded here
+    # as well, so workers inherit it instead of reading certificates each.
+    if preload_app:
+        import app
+        if app.conf.xroad_protocol == "https":
+            utils.get_xroad_ssl_context(app.conf)
+    server.log.info("Server ready: %s workers, mode %s", workers, conf.server_mode)
+
+
+def post_fork(server, worker):
+    # Threads do not survive fork: connection pools, log queue listener and health checks
+    # are recreated in the worker. The X-Road client is created now instead of on first request.
+    if preload_app:
+        import app
+        if conf.server_mode == "wsgi":
+            utils.get_xroad_client(app.conf)
+        # Mutations and downloads of ASiC containers queued before restart are continued
+        utils.defer_background_work = False
+        utils.resume_background_work(app.conf)
+    server.log.info("Worker spawned (pid: %s)", worker.pid)
+
+
+def worker_exit(server, worker):
+    # Write log records still waiting in the queue
+    utils.stop_log_queue()
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# States of a job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Operations that may be executed again if the process was stopped while executing them;
+# create is not repeated, the person may already have been added
+IDEMPOTENT_OPERATIONS = {"edit", "delete"}
+
+
+def person_key(payload: dict):
+    # Person changed by the job (UNZR, id of a person without UNZR), None if unknown
+    key = (payload.get("unzr") or payload.get("id")) if isinstance(payload, dict) else None
+    return str(key) if key else None
+
+
+class JobStore:
+    # Durable queue of person mutations stored in SQLite, shared by all worker processes of the node.
+    # A job is claimed by exactly one worker thread, its result is kept for `retention` seconds.
+    # Jobs of the same person are executed one at a time in the order they were queued.
+    def __init__(self, path: str, retention: float = 86400.0):
+        self.path = path
+        self.retention = retention
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                       "id TEXT PRIMARY KEY, operation TEXT, payload TEXT, status TEXT, status_code INTEGER, "
+                       "result TEXT, error TEXT, owner INTEGER, created_at REAL, started_at REAL, finished_at REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at)")
+            if "person_key" not in {row[1] for row in db.execute("PRAGMA table_info(jobs)")}:
+                # Queue created by an earlier version, unfinished jobs get the key of their person
+                db.execute("ALTER TABLE jobs ADD COLUMN person_key TEXT")
+                rows = db.execute("SELECT id, payload FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchall()
+                db.executemany("UPDATE jobs SET person_key = ? WHERE id = ?",
+                               [(person_key(json.loads(payload)), job_id) for job_id, payload in rows])
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_person_key_status ON jobs (person_key, status)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, created on first use
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def add(self, operation: str, payload: dict) -> str:
+        # Persist the job before it is acknowledged, returns its id
+        job_id = uuid.uuid4().hex
+        with self._connection() as db:
+            db.execute("INSERT INTO jobs (id, operation, payload, status, created_at, person_key) "
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       (job_id, operation, json.dumps(payload), QUEUED, time.time(), person_key(payload)))
+        return job_id
+
+    def get(self, job_id: str):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        if job["status"] == QUEUED:
+            job["position"] = self._connection().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?",
+                (QUEUED, job["created_at"])).fetchone()[0] + 1
+        return job
+
+    def claim(self):
+        # Take the oldest queued job of a person without a running job, None if there is no such job.
+        # An older queued job of the person is always taken first, so jobs of a person (including jobs
+        # queued again by recover()) run in the order they were queued.
+        db = self._connection()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT id, operation, payload FROM jobs AS job WHERE status = ? "
+                             "AND (person_key IS NULL OR NOT EXISTS (SELECT 1 FROM jobs AS other "
+                             "WHERE other.person_key = job.person_key AND other.status = ?)) "
+                             "ORDER BY created_at, rowid LIMIT 1", (QUEUED, RUNNING)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status = ?, owner = ?, started_at = ? WHERE id = ?",
+                           (RUNNING, os.getpid(), now, row["id"]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return (row["id"], row["operation"], json.loads(row["payload"])) if row is not None else None
+
+    def finish(self, job_id: str, status: str, status_code=None, result=None, error: str = None):
+        with self._connection() as db:
+            db.execute("UPDATE jobs SET status = ?, status_code = ?, result = ?, error = ?, owner = NULL, "
+                       "finished_at = ? WHERE id = ?",
+                       (status, status_code, json.dumps(result) if result is not None else None, error,
+                        time.time(), job_id))
+
+    def recover(self) -> tuple:
+        # Jobs of processes that exited while executing them: edit and delete are queued again,
+        # create is failed because its outcome is unknown. Returns (requeued, failed).
+        # utils imports this module, it is imported here to keep the import order free
+        from utils import process_alive
+        db = self._connection()
+        owners = [row[0] for row in db.execute("SELECT DISTINCT owner FROM jobs WHERE status = ?", (RUNNING,))]
+        requeued = failed = 0
+        now = time.time()
+        with db:
+            for owner in owners:
+                if owner is not None and owner != os.getpid() and process_alive(owner):
+                    continue
+                placeholders = ",".join("?" * len(IDEMPOTENT_OPERATIONS))
+                requeued += db.execute(
+                    f"UPDATE jobs SET status = ?, owner = NULL WHERE status = ? AND owner IS ? "
+                    f"AND operation IN ({placeholders})",
+                    (QUEUED, RUNNING, owner, *IDEMPOTENT_OPERATIONS)).rowcount
+                failed += db.execute(
+                    "UPDATE jobs SET status = ?, error = ?, owner = NULL, finished_at = ? "
+                    "WHERE status = ? AND owner IS ?",
+                    (FAILED, "Interrupted by restart, outcome unknown", now, RUNNING, owner)).rowcount
+        return requeued, failed
+
+    def purge(self) -> int:
+        # Remove finished jobs older than retention
+        with self._connection() as db:
+            return db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                              (DONE, FAILED, time.time() - self.retention)).rowcount
+
+    def counts(self) -> dict:
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in rows}
+
+
+class JobQueue:
+    # Executes queued mutations in `workers` background threads, which limits the number of
+    # concurrent mutation requests to the security server. execute(operation, payload) returns
+    # a response with status_code and body (utils.CustomResponse).
+    def __init__(self, store: JobStore, execute, workers: int = 4, poll_interval: float = 1.0):
+        self.store = store
+        self.execute = execute
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._purged_at = 0.0
+
+    def start(self):
+        requeued, failed = self.store.recover()
+        if requeued or failed:
+            logger.warning("Jobs interrupted by restart: %s queued again, %s failed", requeued, failed)
+        for number in range(self.workers):
+            threading.Thread(target=self._run, name=f"job-worker-{number}", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def submit(self, operation: str, payload: dict) -> str:
+        job_id = self.store.add(operation, payload)
+        self._wakeup.set()
+        logger.info("Job %s queued: %s", job_id, operation)
+        return job_id
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                job = self.store.claim()
+            except sqlite3.Error as e:
+                logger.error("Reading job queue failed: %s", e)
+                job = None
+            if job is None:
+                self._purge()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._process(*job)
+
+    def _process(self, job_id: str, operation: str, payload: dict):
+        try:
+            response = self.execute(operation, payload)
+        except Exception as e:
+            logger.error("Job %s (%s) failed: %s", job_id, operation, e)
+            self.store.finish(job_id, FAILED, error=str(e))
+            return
+        status = DONE if response.status_code < 400 else FAILED
+        self.store.finish(job_id, status, response.status_code, response.body)
+        logger.info("Job %s (%s) finished: %s, status code %s", job_id, operation, status, response.status_code)
+
+    def _purge(self):
+        # Old results are removed at most once a minute by an idle worker
+        now = time.monotonic()
+        if now - self._purged_at < 60:
+            return
+        self._purged_at = now
+        try:
+            removed = self.store.purge()
+        except sqlite3.Error as e:
+            logger.error("Removing finished jobs failed: %s", e)
+            return
+        if removed:
+            logger.debug("Removed %s finished jobs", removed)
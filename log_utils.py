@@ -0,0 +1,124 @@
+import datetime
+import json
+import logging
+import random
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, WatchedFileHandler
+
+# Replacement of values of redacted fields in logged payloads
+REDACTED = "***"
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, suitable for log shippers
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        # Always ISO 8601 with timezone, the configured date format is meant for text logs
+        return datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds")
+
+
+class SamplingFilter(logging.Filter):
+    # Passes only a share of DEBUG and INFO records of the configured loggers,
+    # warnings and errors are always passed. rates: {"logger.name": 0.1, ...}
+    def __init__(self, rates: dict):
+        super().__init__()
+        # Longest names first, so the most specific logger wins
+        self.rates = sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+
+    def rate(self, name: str) -> float:
+        for logger_name, rate in self.rates:
+            if name == logger_name or name.startswith(logger_name + "."):
+                return rate
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class PayloadFilter(logging.Filter):
+    # Hides values of sensitive person fields in logged dicts and lists
+    # and truncates messages longer than max_length characters (0 - no limit)
+    def __init__(self, redact_fields, max_length: int):
+        super().__init__()
+        self.redact_fields = set(redact_fields)
+        self.max_length = max_length
+
+    def redact(self, value):
+        if isinstance(value, dict):
+            return {key: REDACTED if key in self.redact_fields else self.redact(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.redact(item) for item in value]
+        return value
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.redact_fields and record.args:
+            if isinstance(record.args, dict):
+                record.args = self.redact(record.args)
+            else:
+                record.args = tuple(self.redact(arg) for arg in record.args)
+        if self.max_length:
+            message = record.getMessage()
+            if len(message) > self.max_length:
+                record.msg = f"{message[:self.max_length]}... ({len(message) - self.max_length} characters truncated)"
+                record.args = None
+        return True
+
+
+def parse_sampling(value: str) -> dict:
+    # "utils=0.1,bulk=0.01" -> {"utils": 0.1, "bulk": 0.01}
+    rates = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition("=")
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+# Rotations done by the process itself, every process writing the file would rotate it separately
+PROCESS_ROTATIONS = ("size", "time")
+
+
+def create_file_handler(config_instance) -> logging.Handler:
+    # Log file handler, rotated by size or by time if configured.
+    # With external rotation (logrotate) the file is reopened after it was moved away.
+    if config_instance.log_rotation == "size":
+        return RotatingFileHandler(config_instance.log_filename, mode=config_instance.log_filemode,
+                                   maxBytes=config_instance.log_max_bytes,
+                                   backupCount=config_instance.log_backup_count, encoding="utf-8")
+    if config_instance.log_rotation == "time":
+        return TimedRotatingFileHandler(config_instance.log_filename, when=config_instance.log_rotation_when,
+                                        interval=config_instance.log_rotation_interval,
+                                        backupCount=config_instance.log_backup_count, encoding="utf-8")
+    if config_instance.log_rotation == "external":
+        return WatchedFileHandler(config_instance.log_filename, mode=config_instance.log_filemode, encoding="utf-8")
+    if config_instance.log_rotation == "none":
+        return logging.FileHandler(config_instance.log_filename, mode=config_instance.log_filemode, encoding="utf-8")
+    raise ValueError(f"Unknown log rotation: {config_instance.log_rotation}")
+
+
+def create_filters(config_instance) -> list:
+    # Filters configured in the [logging] section, sampling first so dropped records are not redacted
+    filters = []
+    rates = parse_sampling(config_instance.log_sampling)
+    if rates:
+        filters.append(SamplingFilter(rates))
+    if config_instance.log_redact_fields or config_instance.log_max_message_length:
+        filters.append(PayloadFilter(config_instance.log_redact_fields, config_instance.log_max_message_length))
+    return filters
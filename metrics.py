@@ -0,0 +1,222 @@
+import math
+import threading
+
+# Metrics of the worker process in Prometheus text exposition format (version 0.0.4).
+# Every worker process keeps its own values, so each worker must be scraped separately.
+
+# Default latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        if not labelnames:
+            self._values[()] = self._initial()
+
+    def _initial(self):
+        return 0.0
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+
+    def _initial(self):
+        # Counts of observations per bucket (not cumulative), sum of observed values
+        return [[0] * len(self.buckets), 0.0]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = self._initial()
+            series[0][index] += 1
+            series[1] += value
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+registry = Registry()
+
+# Incoming requests to the application
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Duration of HTTP requests handled by the application",
+    ("route", "method", "status")))
+http_requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests currently handled by the application", ("route",)))
+http_request_exceptions = registry.register(Counter(
+    "http_request_exceptions_total", "HTTP requests ended with an unhandled exception", ("route", "method")))
+
+# Requests to the security server, operation is one of search, add, edit, delete
+xroad_request_duration = registry.register(Histogram(
+    "xroad_request_duration_seconds", "Duration of requests to the X-Road security server until response headers",
+    ("operation", "status")))
+xroad_requests_in_flight = registry.register(Gauge(
+    "xroad_requests_in_flight", "Requests to the X-Road security server waiting for response", ("operation",)))
+xroad_request_errors = registry.register(Counter(
+    "xroad_request_errors_total", "Requests to the X-Road security server failed without response",
+    ("operation", "error")))
+xroad_received_bytes = registry.register(Counter(
+    "xroad_received_bytes_total", "Response body bytes received from the X-Road security server", ("operation",)))
+xroad_tls_handshakes = registry.register(Counter(
+    "xroad_tls_handshakes_total", "TLS handshakes with the X-Road security server"))
+xroad_tls_reloads = registry.register(Counter(
+    "xroad_tls_reloads_total", "Reloads of client certificate, key and X-Road CA after the files changed",
+    ("result",)))
+xroad_retries = registry.register(Counter(
+    "xroad_retries_total", "Retried requests to the X-Road security server", ("method",)))
+xroad_circuit_breaker_open = registry.register(Gauge(
+    "xroad_circuit_breaker_open", "1 if requests to the X-Road security server are suspended by circuit breaker"))
+xroad_circuit_breaker_opened = registry.register(Counter(
+    "xroad_circuit_breaker_opened_total", "Number of times the circuit breaker opened"))
+xroad_asic_downloads = registry.register(Counter(
+    "xroad_asic_downloads_total", "Download attempts of ASiC containers by result (ok, retry, failed)",
+    ("result",)))
+xroad_asic_downloaded_bytes = registry.register(Counter(
+    "xroad_asic_downloaded_bytes_total", "Bytes of ASiC containers received from the X-Road security server"))
+
+# Security servers of the cluster, host is the base URI of the security server
+xroad_host_requests = registry.register(Counter(
+    "xroad_host_requests_total", "Requests sent to the security server by result", ("host", "result")))
+xroad_host_requests_in_flight = registry.register(Gauge(
+    "xroad_host_requests_in_flight", "Requests to the security server waiting for response", ("host",)))
+xroad_host_ejections = registry.register(Counter(
+    "xroad_host_ejections_total", "Number of times the security server was ejected after failures", ("host",)))
+xroad_host_healthy = registry.register(Gauge(
+    "xroad_host_healthy", "1 if the last health check of the security server succeeded", ("host",)))
+
+# Admission control of requests waiting on the security server
+admission_limit = registry.register(Gauge(
+    "admission_concurrency_limit", "Current limit of concurrent requests waiting on the security server"))
+admission_in_flight = registry.register(Gauge(
+    "admission_requests_in_flight", "Admitted requests waiting on the security server"))
+admission_queued = registry.register(Gauge(
+    "admission_requests_queued", "Requests waiting for admission"))
+admission_rejected = registry.register(Counter(
+    "admission_rejected_total", "Requests rejected with 503 by admission control", ("route", "reason")))
+
+# Outbound scheduling of requests to the security server, priority is interactive or bulk
+xroad_scheduler_wait = registry.register(Histogram(
+    "xroad_scheduler_wait_seconds", "Time requests waited for the request rate limit of the client", ("priority",)))
+xroad_scheduler_queued = registry.register(Gauge(
+    "xroad_scheduler_queued", "Requests waiting for the request rate limit of the client", ("priority",)))
+xroad_rate_limited = registry.register(Counter(
+    "xroad_rate_limited_total", "Requests failed because the request rate limit left no capacity in time",
+    ("priority",)))
+
+# Operation names of the person service methods
+OPERATIONS = {"GET": "search", "POST": "add", "PUT": "edit", "DELETE": "delete"}
+
+
+def render() -> str:
+    return registry.render()
+
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    # Raised without calling the security server while the circuit breaker is open
+    pass
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures and rejects calls for `reset_timeout` seconds,
+    # then lets one trial call through (half-open): success closes the circuit, failure opens it again
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError("Security server is unavailable, requests are suspended by circuit breaker")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit breaker closed")
+                metrics.xroad_circuit_breaker_open.set(0)
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                metrics.xroad_circuit_breaker_open.set(1)
+                metrics.xroad_circuit_breaker_opened.inc()
+                logger.warning("Circuit breaker opened after %s consecutive failures", self.consecutive_failures)
+
+    def release_trial(self):
+        # Call ended without a verdict on the security server (local error, cancellation):
+        # the half-open trial is given back, so the next call can make it
+        with self._lock:
+            self.trial_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+class ResiliencePolicy:
+    # Retries with jittered exponential backoff and circuit breaker around calls to the security server.
+    # Only methods listed in retry_methods are retried, so non-idempotent requests are never repeated.
+    def __init__(self, max_retries: int, retry_methods, retry_statuses, backoff_base: float,
+                 backoff_max: float, breaker: CircuitBreaker):
+        self.max_retries = max_retries
+        self.retry_methods = {method.upper() for method in retry_methods}
+        self.retry_statuses = set(retry_statuses)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self.retries = 0
+
+    def backoff(self, attempt: int) -> float:
+        # "Full jitter": random delay up to the exponential backoff of the attempt
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _attempts(self, method: str) -> int:
+        return 1 + (self.max_retries if method.upper() in self.retry_methods else 0)
+
+    def _failed(self, response) -> bool:
+        return response.status_code in self.retry_statuses
+
+    def _count_retry(self, method: str, attempt: int, reason):
+        with self._lock:
+            self.retries += 1
+        metrics.xroad_retries.inc(method=method)
+        logger.warning("Retrying %s request (attempt %s), reason: %s", method, attempt + 2, reason)
+
+    def call(self, method: str, fn, retry_on=(Exception,), before_attempt=None):
+        # Call fn() returning HTTP response, retry failures allowed for the method.
+        # before_attempt() is called before every attempt (request rate limit), ahead of the circuit breaker,
+        # so its errors are not failures of the security server.
+        attempts = self._attempts(method)
+        for attempt in range(attempts):
+            if before_attempt is not None:
+                before_attempt()
+            self.breaker.before_call()
+            try:
+                response = fn()
+            except retry_on as e:
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                self._count_retry(method, attempt, e)
+                time.sleep(self.backoff(attempt))
+                continue
+            except BaseException:
+                self.breaker.release_trial()
+                raise
+            if not self._failed(response):
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+            if attempt + 1 >= attempts:
+                return response
+            self._count_retry(method, attempt, f"HTTP {response.status_code}")
+            response.close()
+            time.sleep(self.backoff(attempt))
+
+    async def acall(self, method: str, fn, retry_on=(Exception,), before_attempt=None):
+        # Same as call() for coroutine functions, before_attempt is a coroutine function as well
+        attempts = self._attempts(method)
+        for attempt in range(attempts):
+            if before_attempt is not None:
+                await before_attempt()
+            self.breaker.before_call()
+            try:
+                response = await fn()
+            except retry_on as e:
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                self._count_retry(method, attempt, e)
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            except BaseException:
+                self.breaker.release_trial()
+                raise
+            if not self._failed(response):
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+            if attempt + 1 >= attempts:
+                return response
+            self._count_retry(method, attempt, f"HTTP {response.status_code}")
+            await response.aclose()
+            await asyncio.sleep(self.backoff(attempt))
+
+    def stats(self) -> dict:
+        with self._lock:
+            retries = self.retries
+        return {"retries": retries, "circuit_breaker": self.breaker.stats()}
+
+
+def create_resilience_policy(config_instance) -> ResiliencePolicy:
+    # Build policy from the [resilience] section
+    breaker = CircuitBreaker(config_instance.breaker_failure_threshold, config_instance.breaker_reset_timeout)
+    return ResiliencePolicy(
+        max_retries=config_instance.retry_max_retries,
+        retry_methods=config_instance.retry_methods,
+        retry_statuses=config_instance.retry_statuses,
+        backoff_base=config_instance.retry_backoff_base,
+        backoff_max=config_instance.retry_backoff_max,
+        breaker=breaker,
+    )
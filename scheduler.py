@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+
+import metrics
+from throttling import TokenBucket
+
+# Priority classes of requests to the security server, lower is dispatched first
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Priority class of requests sent by the current thread or coroutine
+current_priority = contextvars.ContextVar("xroad_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(value: int):
+    # Send requests made inside the block with the given priority class
+    token = current_priority.set(value)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class OutboundScheduler:
+    # Dispatches requests of one client/service identity at most `rate` per second (bursts up to `burst`).
+    # Waiting requests are dispatched by priority class, then in arrival order, so interactive requests
+    # overtake queued bulk ones. Bulk requests leave bulk_reserve of the burst unused, which keeps
+    # tokens available for interactive requests arriving while a batch is running.
+    def __init__(self, identity: str, rate: float, burst: float = 10, bulk_reserve: float = 0.2,
+                 max_wait: float = 10.0):
+        self.identity = identity
+        self.bucket = TokenBucket(rate, burst)
+        self.bulk_reserve = min(bulk_reserve * self.bucket.burst, self.bucket.burst - 1)
+        self.max_wait = max_wait
+        self._condition = threading.Condition()
+        self._waiting = []  # heap of (priority, sequence)
+        self._sequence = itertools.count()
+        self.dispatched = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.timeouts = {name: 0 for name in PRIORITY_NAMES.values()}
+
+    def _reserve(self, priority_class: int) -> float:
+        return self.bulk_reserve if priority_class >= BULK else 0.0
+
+    def try_dispatch(self, priority_class: int = None) -> bool:
+        # Take a token without waiting, only if no request is queued
+        priority_class = current_priority.get() if priority_class is None else priority_class
+        with self._condition:
+            if self._waiting:
+                return False
+            # try_acquire returns the time to wait for a token, 0 if it was taken
+            if self.bucket.try_acquire(reserve=self._reserve(priority_class)):
+                return False
+            self._dispatched(priority_class, 0.0)
+            return True
+
+    def dispatch(self, priority_class: int = None, timeout: float = None):
+        # Wait for the turn of the request, raises RateLimitTimeout after timeout (default max_wait) seconds
+        priority_class = current_priority.get() if priority_class is None else priority_class
+        timeout = self.max_wait if timeout is None else timeout
+        start = time.monotonic()
+        with self._condition:
+            entry = self._enqueue(priority_class)
+            try:
+                while True:
+                    wait = self._turn(entry, start, timeout)
+                    if wait is None:
+                        return
+                    self._condition.wait(wait)
+            finally:
+                self._dequeue(entry)
+
+    async def adispatch(self, priority_class: int = None, timeout: float = None):
+        # Same as dispatch() for coroutines, the turn is awaited without blocking the event loop or a thread
+        priority_class = current_priority.get() if priority_class is None else priority_class
+        timeout = self.max_wait if timeout is None else timeout
+        start = time.monotonic()
+        with self._condition:
+            entry = self._enqueue(priority_class)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._turn(entry, start, timeout)
+                if wait is None:
+                    return
+                # Requests ahead in line are not waited for by notification, check again after the
+                # time one token takes to refill
+                await asyncio.sleep(min(wait, 1 / self.bucket.rate))
+        finally:
+            with self._condition:
+                self._dequeue(entry)
+
+    def _enqueue(self, priority_class: int) -> tuple:
+        entry = (priority_class, next(self._sequence))
+        heapq.heappush(self._waiting, entry)
+        metrics.xroad_scheduler_queued.inc(priority=PRIORITY_NAMES.get(priority_class, str(priority_class)))
+        return entry
+
+    def _dequeue(self, entry: tuple):
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        metrics.xroad_scheduler_queued.dec(priority=PRIORITY_NAMES.get(entry[0], str(entry[0])))
+        # The next request in line may be dispatched now
+        self._condition.notify_all()
+
+    def _turn(self, entry: tuple, start: float, timeout: float):
+        # Take a token if the request is first in line, None when dispatched, otherwise seconds to wait.
+        # Called with the condition held.
+        priority_class = entry[0]
+        remaining = start + timeout - time.monotonic()
+        if self._waiting[0] == entry:
+            wait = self.bucket.try_acquire(reserve=self._reserve(priority_class))
+            if not wait:
+                self._dispatched(priority_class, time.monotonic() - start)
+                return None
+        else:
+            wait = remaining
+        if remaining <= 0:
+            name = PRIORITY_NAMES.get(priority_class, str(priority_class))
+            self.timeouts[name] = self.timeouts.get(name, 0) + 1
+            metrics.xroad_rate_limited.inc(priority=name)
+            raise RateLimitTimeout(f"Request rate limit of {self.identity} exceeded, "
+                                   f"no capacity within {timeout} s")
+        return min(wait, remaining)
+
+    def _dispatched(self, priority_class: int, waited: float):
+        name = PRIORITY_NAMES.get(priority_class, str(priority_class))
+        self.dispatched[name] = self.dispatched.get(name, 0) + 1
+        metrics.xroad_scheduler_wait.observe(waited, priority=name)
+
+    def stats(self) -> dict:
+        with self._condition:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority_class, _ in self._waiting:
+                name = PRIORITY_NAMES.get(priority_class, str(priority_class))
+                queued[name] = queued.get(name, 0) + 1
+            return {
+                "identity": self.identity,
+                "rate": self.bucket.rate,
+                "burst": self.bucket.burst,
+                "bulk_reserve": self.bulk_reserve,
+                "queued": queued,
+                "dispatched": dict(self.dispatched),
+                "timeouts": dict(self.timeouts),
+            }
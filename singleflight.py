@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+
+class FlightStats:
+    # Counters of executed and coalesced calls, shared by sync and async flights of the process
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def record(self, coalesced: bool):
+        with self._lock:
+            if coalesced:
+                self.coalesced += 1
+            else:
+                self.executed += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"executed": self.executed, "coalesced": self.coalesced}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Coalesces identical concurrent calls: the first caller executes the function,
+    # callers arriving while it is in flight wait for and receive the same result
+    def __init__(self, stats: FlightStats = None):
+        self.stats = stats if stats is not None else FlightStats()
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        self.stats.record(coalesced=not leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines of one event loop
+    def __init__(self, stats: FlightStats = None):
+        self.stats = stats if stats is not None else FlightStats()
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            self.stats.record(coalesced=True)
+            return await asyncio.shield(future)
+
+        self.stats.record(coalesced=False)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieve the exception so it is not reported as unhandled when nobody waits
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
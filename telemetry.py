@@ -0,0 +1,44 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def setup_telemetry(config_instance, flask_app=None) -> bool:
+    # Tracing with OpenTelemetry if enabled in the [open-telemetry] section. The SDK, exporter and
+    # instrumentors take a large share of the startup time, so they are imported only when enabled.
+    if config_instance.telemetry_enabled != "true":
+        return False
+
+    from opentelemetry import trace
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    from opentelemetry.instrumentation.requests import RequestsInstrumentor
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import TraceIdRatioBased
+
+    logger.info("Telemetry enabled")
+    # Set up tracer provider with service name
+    trace.set_tracer_provider(
+        TracerProvider(
+            resource=Resource.create({SERVICE_NAME: config_instance.telemetry_own_service_name}),
+            sampler=TraceIdRatioBased(float(config_instance.telemetry_sample_ratio))
+        )
+    )
+
+    otlp_exporter = OTLPSpanExporter(
+        endpoint=config_instance.telemetry_endpoint,  # OTLP gRPC port by default
+        insecure=True  # No TLS (if Collector has no mTLS)
+    )
+
+    trace.get_tracer_provider().add_span_processor(
+        BatchSpanProcessor(otlp_exporter)
+    )
+
+    # Outgoing requests to the X-Road security server
+    RequestsInstrumentor().instrument()
+    if flask_app is not None:
+        # Instrument Flask (automatically wraps routes in spans)
+        from opentelemetry.instrumentation.flask import FlaskInstrumentor
+        FlaskInstrumentor().instrument_app(flask_app)
+    return True
@@ -0,0 +1,34 @@
+import threading
+import time
+
+
+class TokenBucket:
+    # Thread-safe token bucket: `rate` tokens per second, at most `burst` tokens accumulated.
+    # acquire() blocks until a token is available.
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1, reserve: float = 0) -> float:
+        # Take tokens if available and return 0, otherwise return seconds to wait for them.
+        # With reserve the tokens are taken only if at least `reserve` tokens remain afterwards.
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens + reserve:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens + reserve - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1):
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
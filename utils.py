@@ -1,20 +1,40 @@
+import codecs
 import configparser
+import json
 import uuid
 import re
 from urllib.parse import quote
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.poolmanager import PoolManager
+from urllib3.util.ssl_ import create_urllib3_context
 # from requests import Response
 
-from cryptography import x509
-from cryptography.x509.oid import NameOID
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import serialization
 import datetime
 import os
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 import sys
+import functools
+import threading
+import time
+
+import log_utils
+import metrics
+from cache import CacheRefresher, MemoryCacheBackend, create_cache_backend
+from singleflight import FlightStats, SingleFlight
+from balancer import Balancer, HealthChecker
+from asic_archiver import AsicArchiver, AsicIndex
+from admission import AdaptiveLimiter
+from scheduler import OutboundScheduler, RateLimitTimeout
+from cert_watcher import CertificateWatcher, file_versions
+from file_index import DirectoryIndex
+from jobs import JobQueue, JobStore
+from resilience import CircuitOpenError, ResiliencePolicy, create_resilience_policy
 
 logger = logging.getLogger(__name__)
 
@@ -63,12 +83,31 @@ class Config:
         # X-Road section
         self.xroad_protocol = get_config_value('xroad', 'protocol', required=True)
         self.xroad_host = get_config_value('xroad', 'host', required=True)
+        # One or several security servers of a cluster: "ss1, ss2:8444", the port defaults
+        # to 8443 for https and 8080 for http
+        default_port = 8443 if self.xroad_protocol == "https" else 8080
+        self.xroad_hosts = [host if re.search(r":\d+$", host) else f"{host}:{default_port}"
+                            for host in (h.strip() for h in self.xroad_host.split(',')) if host]
         #self.trembita_purpose = get_config_value('xroad', 'purpose_id', '')
         self.cert_path = get_config_value('xroad', 'cert_path', 'certs')
         self.asic_path = get_config_value('xroad', 'asic_path', 'asic')
         self.cert_file = get_config_value('xroad', 'cert_file', 'cert.pem')
         self.key_file = get_config_value('xroad', 'key_file', 'key.pem')
         self.xroad_cert_file = get_config_value('xroad', 'xroad_cert_file' , 'xroad.pem')
+        # Maximum number of keep-alive connections to the security server kept per worker process
+        self.xroad_pool_size = int(get_config_value('xroad', 'pool_size', '10'))
+        # Use HTTP/2 for the asynchronous (ASGI) client if the security server supports it
+        self.xroad_http2 = get_config_value('xroad', 'http2', 'false')
+        # Distribution of requests across security servers: least_outstanding or round_robin
+        self.xroad_balancing = get_config_value('xroad', 'balancing', 'least_outstanding')
+        # A security server is skipped for eject_time seconds after eject_failures consecutive failures
+        self.xroad_eject_failures = int(get_config_value('xroad', 'eject_failures', '3'))
+        self.xroad_eject_time = float(get_config_value('xroad', 'eject_time', '30'))
+        # Background health checks of security servers (interval in seconds, 0 - disabled)
+        self.xroad_health_check_interval = float(get_config_value('xroad', 'health_check_interval', '10'))
+        self.xroad_health_check_path = get_config_value('xroad', 'health_check_path', '/')
+        # Certificate files are checked for changes every cert_reload_interval seconds (0 - disabled)
+        self.xroad_cert_reload_interval = float(get_config_value('xroad', 'cert_reload_interval', '10'))
         # Client subsystem identifiers
         self.client_instance = get_config_value('client', 'instance', required=True)
         self.client_org_type = get_config_value('client', 'memberClass', required=True)
@@ -81,12 +120,108 @@ class Config:
         self.service_org_sub = get_config_value('service', 'subsystemCode', required=True)
         self.service_org_name = get_config_value('service', 'serviceCode', required=True)
         self.service_org_version = get_config_value('service', 'serviceVersion')
+        # Person search results cache
+        self.cache_enabled = get_config_value('cache', 'enabled', 'false')
+        self.cache_max_entries = int(get_config_value('cache', 'max_entries', '1024'))
+        self.cache_ttl = float(get_config_value('cache', 'ttl', '30'))
+        # memory - cache of each worker process, shared - one cache for all workers of the node,
+        # disk - shared cache kept on disk which survives restarts
+        self.cache_backend = get_config_value('cache', 'backend', 'memory')
+        self.cache_shared_path = get_config_value('cache', 'shared_path', '')
+        self.cache_disk_path = get_config_value('cache', 'disk_path', 'person_cache.sqlite3')
+        # Expired entries are served for max_stale more seconds while they are refreshed in the background
+        self.cache_max_stale = float(get_config_value('cache', 'max_stale', '0'))
+        # Total size of cached results in bytes (0 - limited by max_entries only)
+        self.cache_max_bytes = int(get_config_value('cache', 'max_bytes', '0'))
+        self.cache_refresh_workers = int(get_config_value('cache', 'refresh_workers', '2'))
+        # Render search results while they are received from the security server
+        self.search_stream_results = get_config_value('search', 'stream_results', 'false')
+        # Number of persons per page of search results (0 - show all persons on one page)
+        self.search_page_size = int(get_config_value('search', 'page_size', '50'))
+        # Search results are kept for paging for result_ttl seconds
+        self.search_result_ttl = float(get_config_value('search', 'result_ttl', '120'))
+        self.search_result_cache_entries = int(get_config_value('search', 'result_cache_entries', '256'))
+        # Certificate list: files per page, full rescan of the directory every rescan_interval seconds
+        self.files_page_size = int(get_config_value('files', 'page_size', '50'))
+        self.files_rescan_interval = float(get_config_value('files', 'rescan_interval', '60'))
+        # Background download of ASiC containers from the security server
+        self.asic_workers = int(get_config_value('asic', 'workers', '4'))
+        self.asic_max_retries = int(get_config_value('asic', 'max_retries', '5'))
+        self.asic_backoff_base = float(get_config_value('asic', 'backoff_base', '1'))
+        self.asic_backoff_max = float(get_config_value('asic', 'backoff_max', '60'))
+        # Containers of all successful queries are archived archive_delay seconds after the query
+        self.asic_archive_queries = get_config_value('asic', 'archive_queries', 'false')
+        self.asic_archive_delay = float(get_config_value('asic', 'archive_delay', '60'))
+        # Person mutations queued and executed in background (/create, /edit, /delete with async=true)
+        self.jobs_async_mutations = get_config_value('jobs', 'async_mutations', 'false')
+        self.jobs_workers = int(get_config_value('jobs', 'workers', '4'))
+        self.jobs_path = get_config_value('jobs', 'path', 'jobs.sqlite3')
+        self.jobs_retention = float(get_config_value('jobs', 'retention', '86400'))
+        # Adaptive limit of concurrent requests waiting on the security server, excess is rejected with 503
+        self.admission_enabled = get_config_value('admission', 'enabled', 'false')
+        self.admission_min_limit = int(get_config_value('admission', 'min_limit', '4'))
+        self.admission_max_limit = int(get_config_value('admission', 'max_limit', '200'))
+        self.admission_initial_limit = int(get_config_value('admission', 'initial_limit', '20'))
+        self.admission_max_queue = int(get_config_value('admission', 'max_queue', '50'))
+        self.admission_queue_timeout = float(get_config_value('admission', 'queue_timeout', '2'))
+        self.admission_tolerance = float(get_config_value('admission', 'tolerance', '2'))
+        # Requests per second to the service per worker process (0 - unlimited), interactive requests first
+        self.scheduler_rate = float(get_config_value('scheduler', 'rate', '0'))
+        self.scheduler_burst = float(get_config_value('scheduler', 'burst', '10'))
+        self.scheduler_bulk_reserve = float(get_config_value('scheduler', 'bulk_reserve', '0.2'))
+        self.scheduler_max_wait = float(get_config_value('scheduler', 'max_wait', '10'))
+        # Bulk operations
+        self.bulk_concurrency = int(get_config_value('bulk', 'concurrency', '8'))
+        self.bulk_max_items = int(get_config_value('bulk', 'max_items', '10000'))
+        self.bulk_rate_limit = float(get_config_value('bulk', 'rate_limit', '0'))
+        # Timeouts (seconds), retries and circuit breaker for requests to the security server
+        self.xroad_connect_timeout = float(get_config_value('resilience', 'connect_timeout', '5'))
+        self.xroad_read_timeout = float(get_config_value('resilience', 'read_timeout', '30'))
+        self.retry_max_retries = int(get_config_value('resilience', 'max_retries', '2'))
+        # Only idempotent methods are retried by default
+        self.retry_methods = [m.strip().upper() for m in
+                              get_config_value('resilience', 'retry_methods', 'GET,DELETE').split(',') if m.strip()]
+        self.retry_statuses = [int(s) for s in
+                               get_config_value('resilience', 'retry_statuses', '502,503,504').split(',') if s.strip()]
+        self.retry_backoff_base = float(get_config_value('resilience', 'backoff_base', '0.2'))
+        self.retry_backoff_max = float(get_config_value('resilience', 'backoff_max', '2'))
+        self.breaker_failure_threshold = int(get_config_value('resilience', 'failure_threshold', '5'))
+        self.breaker_reset_timeout = float(get_config_value('resilience', 'reset_timeout', '30'))
+        # Production server (gunicorn.conf.py): wsgi - Flask application in threaded workers,
+        # asgi - ASGI application in uvicorn workers. 0 workers/threads - derived from CPU count and pool size
+        self.server_bind = get_config_value('server', 'bind', '0.0.0.0:5000')
+        self.server_mode = get_config_value('server', 'mode', 'wsgi')
+        self.server_workers = int(get_config_value('server', 'workers', '0'))
+        self.server_threads = int(get_config_value('server', 'threads', '0'))
+        self.server_timeout = int(get_config_value('server', 'timeout', '60'))
+        self.server_graceful_timeout = int(get_config_value('server', 'graceful_timeout', '30'))
+        self.server_keepalive = int(get_config_value('server', 'keepalive', '5'))
+        self.server_max_requests = int(get_config_value('server', 'max_requests', '0'))
+        self.server_max_requests_jitter = int(get_config_value('server', 'max_requests_jitter', '0'))
+        self.server_preload = get_config_value('server', 'preload', 'true')
         # Logging parameters
         self.log_filename = get_config_value('logging', 'filename')
         self.log_filemode = get_config_value('logging', 'filemode', 'a')
         self.log_format = get_config_value('logging', 'format', '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         self.log_dateformat = get_config_value('logging', 'dateformat', '%Y-%m-%d %H:%M:%S')
         self.log_level = get_config_value('logging', 'level', 'INFO', required=True)
+        # Write log records in a background thread, so request threads never wait for log I/O
+        self.log_queue = get_config_value('logging', 'queue', 'false')
+        # One JSON object per log record instead of the text format
+        self.log_json = get_config_value('logging', 'json', 'false')
+        # none, size (max_bytes per file) or time (every rotation_interval of rotation_when)
+        self.log_rotation = get_config_value('logging', 'rotation', 'none')
+        self.log_max_bytes = int(get_config_value('logging', 'max_bytes', '10485760'))
+        self.log_backup_count = int(get_config_value('logging', 'backup_count', '5'))
+        self.log_rotation_when = get_config_value('logging', 'rotation_when', 'midnight')
+        self.log_rotation_interval = int(get_config_value('logging', 'rotation_interval', '1'))
+        # Share of DEBUG/INFO records kept per logger, e.g. "utils=0.1,bulk=0.01"
+        self.log_sampling = get_config_value('logging', 'sampling', '')
+        # Person fields hidden in logged payloads and maximum length of a log message (0 - no limit)
+        self.log_redact_fields = [f.strip() for f in
+                                  get_config_value('logging', 'redact_fields', 'rnokpp,passportNumber').split(',')
+                                  if f.strip()]
+        self.log_max_message_length = int(get_config_value('logging', 'max_message_length', '2000'))
         # OpenTelemetry parameters
         self.telemetry_enabled = get_config_value('open-telemetry', 'enabled', 'false')
         self.telemetry_own_service_name = get_config_value('open-telemetry', 'own-service-name', 'x-road_rest_client_example')
@@ -100,30 +235,76 @@ class Config:
 
 def configure_logging(config_instance):
     log_filename = config_instance.log_filename
-    log_filemode = config_instance.log_filemode
     log_format = config_instance.log_format
     log_datefmt = config_instance.log_dateformat
     log_level = config_instance.log_level
 
     # If log_filename is not provided, log to console
     if log_filename:
-        # Logging to file
-        logging.basicConfig(
-            filename=log_filename,
-            filemode=log_filemode,
-            format=log_format,
-            datefmt=log_datefmt,
-            level=getattr(logging, log_level, logging.INFO)
-        )
-        logger.info("Logging configured")
+        # Logging to file, optionally rotated by size or time
+        handler = log_utils.create_file_handler(config_instance)
     else:
         # Console logging for Docker
-        logging.basicConfig(
-            format=log_format,
-            datefmt=log_datefmt,
-            level=log_level,
-            handlers=[logging.StreamHandler()]  # Output to stdout
-        )
+        handler = logging.StreamHandler()  # Output to stdout
+    if config_instance.log_json == "true":
+        handler.setFormatter(log_utils.JsonFormatter())
+    logging.basicConfig(
+        format=log_format,
+        datefmt=log_datefmt,
+        level=getattr(logging, log_level, logging.INFO),
+        handlers=[handler]
+    )
+    if config_instance.log_queue == "true":
+        start_log_queue()
+    # Filters run in the request thread before the record is formatted or queued
+    for log_filter in log_utils.create_filters(config_instance):
+        for root_handler in logging.getLogger().handlers:
+            root_handler.addFilter(log_filter)
+    logger.info("Logging configured")
+
+
+# Background thread writing log records of the process, if enabled
+_log_listener = None
+
+
+def start_log_queue():
+    # Move handlers of the root logger behind a queue: callers only enqueue records,
+    # formatting and file I/O happen in the listener thread
+    global _log_listener
+    root = logging.getLogger()
+    handlers = [handler for handler in root.handlers if not isinstance(handler, QueueHandler)]
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_log_queue)
+
+
+def stop_log_queue():
+    # Write remaining records and stop the listener thread
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def _restart_log_queue():
+    # The listener thread does not survive fork, every worker process starts its own
+    global _log_listener
+    if _log_listener is None:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            handler.queue = log_queue
+    _log_listener = QueueListener(log_queue, *_log_listener.handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_log_queue)
 
 
 # def download_asic_from_trembita(queryId: str, config_instance):
@@ -183,7 +364,13 @@ def configure_logging(config_instance):
 def generate_key_cert_rsa(key: str, crt: str, path: str):
     # RSA key and certificate generation
     logger.info("Generating RSA key and certificate")
-    logger.debug(f"Key filename: {key}, certificate filename: {crt}, directory: {path}")
+    # Imported on demand, see generate_key_cert
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    logger.debug("Key filename: %s, certificate filename: %s, directory: %s", key, crt, path)
     private_key = rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048,
@@ -226,23 +413,29 @@ def generate_key_cert_rsa(key: str, crt: str, path: str):
                 format=serialization.PrivateFormat.TraditionalOpenSSL,
                 encryption_algorithm=serialization.NoEncryption()
             ))
-        logger.info(f"Key saved at {key_full_path}")
+        logger.info("Key saved at %s", key_full_path)
 
         # Save certificate to file
         crt_full_path = os.path.join(path, crt)
 
         with open(crt_full_path, "wb") as f:
             f.write(cert.public_bytes(serialization.Encoding.PEM))
-        logger.info(f"Certificate saved at {crt_full_path}")
+        logger.info("Certificate saved at %s", crt_full_path)
     except IOError as e:
-        logger.error(f"Error saving key or certificate: {e}")
+        logger.error("Error saving key or certificate: %s", e)
         raise
 
 
-def generate_key_cert(key: str, crt: str, path: str):
-    # Private key and certificate generation
+def generate_key_cert(key: str, crt: str, path: str, hostname: str = "test.com"):
+    # Private key and certificate generation, hostname is used as common name and DNS name of the certificate
     logger.info("Generating ECDSA key and certificate")
-    logger.debug(f"Key filename: {key}, certificate filename: {crt}, directory: {path}")
+    # cryptography is imported only when a key has to be generated, it is not needed on every start
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    logger.debug("Key filename: %s, certificate filename: %s, directory: %s", key, crt, path)
 
     # Generate ECDSA private key
     private_key = ec.generate_private_key(ec.SECP256R1())
@@ -253,7 +446,7 @@ def generate_key_cert(key: str, crt: str, path: str):
         x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Dhaka"),
         x509.NameAttribute(NameOID.LOCALITY_NAME, "Dhaka"),
         x509.NameAttribute(NameOID.ORGANIZATION_NAME, "The Best Company"),
-        x509.NameAttribute(NameOID.COMMON_NAME, "test.com"),
+        x509.NameAttribute(NameOID.COMMON_NAME, hostname),
     ])
 
     # Create self-signed certificate
@@ -271,7 +464,7 @@ def generate_key_cert(key: str, crt: str, path: str):
         # Certificate is valid for 1 year
         datetime.datetime.utcnow() + datetime.timedelta(days=365)
     ).add_extension(
-        x509.SubjectAlternativeName([x509.DNSName("test.com")]),
+        x509.SubjectAlternativeName([x509.DNSName(hostname)]),
         critical=False,
     ).sign(private_key, hashes.SHA256())
 
@@ -284,15 +477,15 @@ def generate_key_cert(key: str, crt: str, path: str):
                 format=serialization.PrivateFormat.TraditionalOpenSSL,
                 encryption_algorithm=serialization.NoEncryption()
             ))
-        logger.info(f"Key saved at {key_full_path}")
+        logger.info("Key saved at %s", key_full_path)
 
         # Save certificate to file
         crt_full_path = os.path.join(path, crt)
         with open(crt_full_path, "wb") as f:
             f.write(cert.public_bytes(serialization.Encoding.PEM))
-        logger.info(f"Certificate saved at {crt_full_path}")
+        logger.info("Certificate saved at %s", crt_full_path)
     except IOError as e:
-        logger.error(f"Error saving key or certificate: {e}")
+        logger.error("Error saving key or certificate: %s", e)
         raise
 
 # def get_uxp_headers_from_config(config_instance) -> dict:
@@ -379,7 +572,7 @@ def get_xroad_headers_from_config(config_instance) -> dict:
         # xroad_query_issue_header_name: xroad_query_issue_header_value,
         # uxp_sevice_purpose_id: purpose_id_value
     }
-    logger.debug(f"X-Road headers constructed: {headers}")
+    logger.debug("X-Road headers constructed: %s", headers)
     return headers
 
 # def get_uxp_query_params() -> dict:
@@ -412,187 +605,1071 @@ def get_xroad_headers_from_config(config_instance) -> dict:
 #     return uri
 
 
+def get_xroad_base_uris(config_instance) -> list:
+    # Base URIs of all configured security servers
+    return [f"{config_instance.xroad_protocol}://{host}" for host in config_instance.xroad_hosts]
+
+
 def get_base_xroad_uri(config_instance) -> str:
-    # Compose base URI for calling service via X-Road security server
+    # Compose base URI for calling service via X-Road security server (the first one of a cluster)
     logger.debug("Composing base X-Road URL for the client")
-    if config_instance.xroad_protocol == "https":
-        uri = f"https://{config_instance.xroad_host}:8443"
-    else:
-        uri = f"http://{config_instance.xroad_host}:8080"
-    logger.debug(f"Base X-Road service calling URI: {uri}")
+    uri = get_xroad_base_uris(config_instance)[0]
+    logger.debug("Base X-Road service calling URI: %s", uri)
     return uri
 
-def get_rest_xroad_uri(config_instance) -> str:
-    # Compose full URI for REST API request via security server
-    logger.debug("Composing full REST URL for X-Road client")
-    uri = get_base_xroad_uri(config_instance) + (
+
+def get_rest_xroad_path(config_instance) -> str:
+    # Compose path of the REST service, the same on every security server
+    return (
         f"/r1/{config_instance.service_instance}/"
         f"{config_instance.service_org_type}/"
         f"{config_instance.service_org_code}/"
         f"{config_instance.service_org_sub}/"
         f"{config_instance.service_org_name}"
     )
-    logger.debug(f"REST X-Road service calling URI: {uri}")
+
+
+def get_rest_xroad_uri(config_instance) -> str:
+    # Compose full URI for REST API request via security server
+    logger.debug("Composing full REST URL for X-Road client")
+    uri = get_base_xroad_uri(config_instance) + get_rest_xroad_path(config_instance)
+    logger.debug("REST X-Road service calling URI: %s", uri)
     return uri
 
 
-def get_person_from_service(parameter: str, value: str, config_instance) -> list:
-    # Retrieve person information by parameter via X-Road service
-    base_uri = get_rest_xroad_uri(config_instance) + "/person"
-    headers = get_xroad_headers_from_config(config_instance)
-    query_params = None  # get_uxp_query_params()
-
-    url = f"{base_uri}/{parameter}/{value}"
-    encoded_url = quote(url, safe=':/')
-    logger.info(f"Retrieving person information with parameter: {parameter} and value: {value}")
-    try:
-        if config_instance.xroad_protocol == "https":
-            # Send HTTPS request to retrieve person data
-            response = requests.get(encoded_url, headers=headers, params=query_params,
-                                    cert=(os.path.join(config_instance.cert_path, config_instance.cert_file),
-                                          os.path.join(config_instance.cert_path, config_instance.key_file)),
-                                    verify=os.path.join(config_instance.cert_path, config_instance.xroad_cert_file))
+class PoolStats:
+    # Thread-safe counters of connection reuse (hit) versus new connection (miss)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-            #download_asic_from_trembita(query_params.get('queryId'), config_instance)
-        else:
-            # Send HTTP request to retrieve person data
-            response = requests.get(encoded_url, headers=headers, params=query_params)
+    def record(self, reused: bool):
+        with self._lock:
+            if reused:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+class _CountingPoolMixin:
+    pool_stats = None
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        # A connection with an open socket was taken from the pool, otherwise a new
+        # TCP connect (and TLS handshake for https) will happen on first use
+        if self.pool_stats is not None:
+            self.pool_stats.record(conn.sock is not None)
+        return conn
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        super().connect()
+        metrics.xroad_tls_handshakes.inc()
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class _CountingPoolManager(PoolManager):
+    def __init__(self, *args, pool_stats=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_stats = pool_stats
+        self.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context=request_context)
+        pool.pool_stats = self.pool_stats
+        return pool
+
+
+class XRoadAdapter(HTTPAdapter):
+    # Transport adapter that keeps connections to the security server alive and uses
+    # an SSL context with the client certificate and X-Road CA loaded only once
+    def __init__(self, ssl_context=None, pool_stats=None, **kwargs):
+        self.ssl_context = ssl_context
+        self.pool_stats = pool_stats if pool_stats is not None else PoolStats()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        if self.ssl_context is not None:
+            pool_kwargs["ssl_context"] = self.ssl_context
+        self.poolmanager = _CountingPoolManager(
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            pool_stats=self.pool_stats,
+            **pool_kwargs,
+        )
 
 
-    except Exception as e:
-        logger.error(f"Error retrieving person information: {e}")
-        raise ValueError(f"Error while sending HTTP GET: {e}")
+def get_tls_material_paths(config_instance) -> list:
+    # Files of the TLS material: client certificate, client key and X-Road CA certificate
+    return [os.path.join(config_instance.cert_path, config_instance.cert_file),
+            os.path.join(config_instance.cert_path, config_instance.key_file),
+            os.path.join(config_instance.cert_path, config_instance.xroad_cert_file)]
+
+
+def create_xroad_ssl_context(config_instance):
+    # Build SSL context for mutual authentication with the X-Road security server
+    logger.debug("Loading TLS material for X-Road security server connection")
+    cert, key, xroad_cert = get_tls_material_paths(config_instance)
+    context = create_urllib3_context()
+    context.load_verify_locations(cafile=xroad_cert)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+# TLS contexts are kept across fork: loaded once in the preloading master process, shared by all workers.
+# Versions of the files the context was loaded from are used to detect certificate rotation.
+_ssl_contexts = {}
+_ssl_context_versions = {}
+
 
+def get_xroad_ssl_context(config_instance):
+    # Return SSL context of the configuration, loading certificates on first use
+    context = _ssl_contexts.get(id(config_instance))
+    if context is None:
+        with _xroad_clients_lock:
+            context = _ssl_contexts.get(id(config_instance))
+            if context is None:
+                versions = file_versions(get_tls_material_paths(config_instance))
+                context = create_xroad_ssl_context(config_instance)
+                _ssl_contexts[id(config_instance)] = context
+                _ssl_context_versions[id(config_instance)] = versions
+    return context
+
+
+def reload_xroad_ssl_context(config_instance):
+    # Load changed TLS material into a new context and replace the current one. Clients switch
+    # to the new context on their next request, requests in progress finish on the old connections.
+    versions = file_versions(get_tls_material_paths(config_instance))
+    try:
+        context = create_xroad_ssl_context(config_instance)
+    except Exception:
+        metrics.xroad_tls_reloads.inc(result="failed")
+        raise
+    with _xroad_clients_lock:
+        _ssl_contexts[id(config_instance)] = context
+        _ssl_context_versions[id(config_instance)] = versions
+    metrics.xroad_tls_reloads.inc(result="ok")
+    logger.info("TLS material for X-Road security server reloaded from %s", config_instance.cert_path)
+    return context
+
+
+def watch_tls_material(config_instance):
+    # Start checking certificate files of the configuration for changes in the current process
+    if config_instance.xroad_protocol != "https" or config_instance.xroad_cert_reload_interval <= 0:
+        return None
+    watcher = _cert_watchers.get(id(config_instance))
+    if watcher is None:
+        with _xroad_clients_lock:
+            watcher = _cert_watchers.get(id(config_instance))
+            if watcher is None:
+                get_xroad_ssl_context(config_instance)
+                watcher = CertificateWatcher(get_tls_material_paths(config_instance),
+                                             lambda: reload_xroad_ssl_context(config_instance),
+                                             config_instance.xroad_cert_reload_interval,
+                                             _ssl_context_versions[id(config_instance)]).start()
+                _cert_watchers[id(config_instance)] = watcher
+    return watcher
+
+
+def create_xroad_session(config_instance, ssl_context=None, pool_stats=None) -> requests.Session:
+    # Create HTTP session with connection pool to the X-Road security server
+    if ssl_context is None and config_instance.xroad_protocol == "https":
+        ssl_context = get_xroad_ssl_context(config_instance)
+    # One connection pool per security server
+    adapter = XRoadAdapter(ssl_context=ssl_context, pool_stats=pool_stats,
+                           pool_connections=len(config_instance.xroad_hosts),
+                           pool_maxsize=config_instance.xroad_pool_size)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    logger.info("X-Road connection pool created, size: %s", config_instance.xroad_pool_size)
+    return session
+
+
+class XRoadSession:
+    # Session of the X-Road client following reloads of the TLS material: when the SSL context
+    # was replaced, the next request gets a new session (and connection pool) using it. The old
+    # session is closed, idle connections are closed at once and connections of requests in
+    # progress when they are returned.
+    def __init__(self, config_instance, pool_stats=None):
+        self.config = config_instance
+        self.pool_stats = pool_stats if pool_stats is not None else PoolStats()
+        self.ssl_context = None
+        if config_instance.xroad_protocol == "https":
+            self.ssl_context = get_xroad_ssl_context(config_instance)
+        self.session = create_xroad_session(config_instance, self.ssl_context, self.pool_stats)
+        self._lock = threading.Lock()
+
+    def current(self) -> requests.Session:
+        if self.ssl_context is None:
+            return self.session
+        context = get_xroad_ssl_context(self.config)
+        if context is not self.ssl_context:
+            with self._lock:
+                if context is not self.ssl_context:
+                    old_session = self.session
+                    self.session = create_xroad_session(self.config, context, self.pool_stats)
+                    self.ssl_context = context
+                    old_session.close()
+        return self.session
+
+
+def person_list_from_response(response) -> list:
+    # Extract list of persons from the service response (requests or httpx)
     if response.status_code == 200:
         json_data = response.json()
         message_list = json_data.get('message', [])
         logger.info("Request for person information processed")
-        logger.debug(f"Received person data: {message_list}")
+        logger.debug("Received person data: %s", message_list)
         return message_list
-    logger.error(f"Received HTTP code: {response.status_code}, error message: {response.text}")
+    logger.error("Received HTTP code: %s, error message: %s", response.status_code, response.text)
     raise ValueError(f"Received HTTP code: {response.status_code}, error message: {response.text}")
 
 
-def edit_person_in_service(data: dict, config_instance) -> CustomResponse:
-    # Edit person information via X-Road service
-    base_url = get_rest_xroad_uri(config_instance) + "/person"
-    headers = get_xroad_headers_from_config(config_instance)
-    query_params = None  # get_uxp_query_params()
-    url = base_url
-
-    logger.debug(f"Editing person information: {data}")
+class JsonArrayItemParser:
+    # Incremental parser of response body {"<key>": [item, item, ...]}. Chunks of the body are fed as they
+    # are received and complete items are returned as soon as they are parsed, so only the item being
+    # parsed is kept in memory, not the whole body. Only `key` of the top-level object is read.
+    _structure = re.compile(r'["{}\[\]]')
+    _number_tail = re.compile(r'[0-9.eE+-]*')
+
+    def __init__(self, key: str = 'message'):
+        self.key = key
+        self.done = False
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ""
+        self._position = 0
+        self._state = "key"  # key: looking for the array, items: inside the array, whole: value is not a list
+        self._depth = 0
+        self._object = False
+
+    def feed(self, chunk: bytes) -> list:
+        self._buffer += self._text_decoder.decode(chunk)
+        return self._parse(final=False)
+
+    def close(self) -> list:
+        # End of the body, returns the remaining items
+        self._buffer += self._text_decoder.decode(b"", final=True)
+        items = self._parse(final=True)
+        if self._state == "items" and not self.done:
+            raise ValueError("Unexpected end of response while reading person list")
+        return items
+
+    def _parse(self, final: bool) -> list:
+        if self._state == "key":
+            self._find_array(final)
+        if self._state == "whole":
+            if final:
+                self.done = True
+                value = json.loads(self._buffer).get(self.key, [])
+                return value if isinstance(value, list) else []
+            return []
+        if self._state != "items" or self.done:
+            return []
+        return self._parse_items(final)
+
+    def _find_array(self, final: bool):
+        # Skip strings and nested values, so that the same key inside another value does not match
+        buffer = self._buffer
+        while True:
+            match = self._structure.search(buffer, self._position)
+            if match is None:
+                self._position = len(buffer)
+                return
+            position = match.start()
+            char = buffer[position]
+            if char != '"':
+                self._depth += 1 if char in '{[' else -1
+                if self._depth == 1 and char in '{[':
+                    self._object = char == '{'
+                self._position = position + 1
+                continue
+            try:
+                name, end = self._decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                # String continues in the next chunk
+                self._position = position
+                return
+            if self._depth == 1 and self._object and name == self.key:
+                value = self._value_start(buffer, end)
+                if value is None:
+                    if final:
+                        return
+                    # The colon or the value is in the next chunk
+                    self._position = position
+                    return
+                if value > 0:
+                    if buffer[value] == '[':
+                        self._state = "items"
+                        self._position = value + 1
+                    else:
+                        self._state = "whole"
+                    return
+            self._position = end
+
+    @staticmethod
+    def _value_start(buffer: str, end: int):
+        # Position of the value after key ending at `end`, None if not received yet, -1 if it is not a key
+        position = end
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+        if position >= len(buffer):
+            return None
+        if buffer[position] != ':':
+            return -1
+        position += 1
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+        return position if position < len(buffer) else None
+
+    def _parse_items(self, final: bool) -> list:
+        items = []
+        buffer = self._buffer
+        position = self._position
+        while True:
+            # Skip separators between items
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position >= len(buffer):
+                break
+            if buffer[position] == ']':
+                self.done = True
+                break
+            try:
+                item, end = self._decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break
+            if (not final and isinstance(item, (int, float)) and not isinstance(item, bool)
+                    and self._number_tail.fullmatch(buffer, end)):
+                # A number may continue in the next chunk (e.g. "15000000000." or "1e"), decode it again
+                # with more data
+                break
+            items.append(item)
+            position = end
+        if position > 65536:
+            # Drop consumed part of the buffer
+            self._buffer = buffer[position:]
+            position = 0
+        self._position = position
+        return items
+
+
+def iter_json_array_items(chunks, key: str = 'message'):
+    # Incrementally parse response body {"<key>": [item, item, ...]} yielding items one by one
+    parser = JsonArrayItemParser(key)
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+            if parser.done:
+                return
+    yield from parser.close()
+
+
+class XRoadClient:
+    # Transport to the X-Road REST service built once from configuration.
+    # Only the X-Road-Id header is generated per call, everything else is precomputed.
+    def __init__(self, config_instance):
+        self.config = config_instance
+        self.sessions = XRoadSession(config_instance)
+        self.pool_stats = self.sessions.pool_stats
+        self.person_path = get_rest_xroad_path(config_instance) + "/person"
+        self.balancer = get_balancer(config_instance)
+        self.query_id_prefix = f"{config_instance.client_instance}-"
+        self.static_headers = get_xroad_headers_from_config(config_instance)
+        del self.static_headers["X-Road-Id"]
+        self.timeout = (config_instance.xroad_connect_timeout, config_instance.xroad_read_timeout)
+        self.resilience = get_resilience_policy(config_instance)
+        self.archive_queries = config_instance.asic_archive_queries == "true"
+        self.admission = get_admission_limiter(config_instance)
+        self.scheduler = get_scheduler(config_instance)
+        watch_tls_material(config_instance)
+
+    def new_headers(self) -> dict:
+        # Static headers plus unique X-Road-Id of the query
+        headers = self.static_headers.copy()
+        headers["X-Road-Id"] = self.query_id_prefix + str(uuid.uuid4())
+        return headers
+
+    def send(self, method: str, path: str, **kwargs) -> requests.Response:
+        # Send request to one of the security servers over the pooled connection.
+        # Every attempt of a retried request is a new X-Road query with its own X-Road-Id
+        # and may be sent to another security server. Every attempt waits for the request rate limit.
+        return self.resilience.call(
+            method,
+            lambda: self._request(method, path, **kwargs),
+            retry_on=(requests.exceptions.ConnectionError, requests.exceptions.Timeout),
+            before_attempt=self.scheduler.dispatch if self.scheduler is not None else None)
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        # Single attempt of the request, measured for metrics
+        operation = metrics.OPERATIONS.get(method, method.lower())
+        node = self.balancer.acquire()
+        metrics.xroad_requests_in_flight.inc(operation=operation)
+        start = time.perf_counter()
+        ok = False
+        streamed = False
+        headers = self.new_headers()
+        try:
+            response = self.sessions.current().request(method, node.base_uri + path, headers=headers,
+                                                       timeout=self.timeout, **kwargs)
+            ok = response.status_code < 500
+            # Latency of a streamed result includes reading its body, it is observed by the reader
+            streamed = bool(kwargs.get("stream")) and response.status_code == 200
+            response.xroad_started = start
+        except Exception as e:
+            metrics.xroad_request_duration.observe(time.perf_counter() - start, operation=operation, status="error")
+            metrics.xroad_request_errors.inc(operation=operation, error=type(e).__name__)
+            raise
+        finally:
+            metrics.xroad_requests_in_flight.dec(operation=operation)
+            self.balancer.release(node, ok)
+            if self.admission is not None and not streamed:
+                self.admission.observe(time.perf_counter() - start, failed=not ok)
+        metrics.xroad_request_duration.observe(time.perf_counter() - start, operation=operation,
+                                               status=response.status_code)
+        if not kwargs.get("stream"):
+            metrics.xroad_received_bytes.inc(len(response.content), operation=operation)
+        if self.archive_queries and response.status_code < 400:
+            archive_query(headers["X-Road-Id"], node.base_uri, self.config)
+        return response
+
+    def get_person(self, parameter: str, value: str) -> list:
+        # Retrieve person information by parameter via X-Road service
+        path = quote(f"{self.person_path}/{parameter}/{value}", safe=':/')
+        logger.info("Retrieving person information with parameter: %s and value: %s", parameter, value)
+        try:
+            response = self.send("GET", path)
+        except Exception as e:
+            logger.error("Error retrieving person information: %s", e)
+            raise ValueError(f"Error while sending HTTP GET: {e}")
+        return person_list_from_response(response)
+
+    def iter_persons(self, parameter: str, value: str):
+        # Retrieve person information as an iterator, the response body is parsed while it is received
+        path = quote(f"{self.person_path}/{parameter}/{value}", safe=':/')
+        logger.info("Streaming person information with parameter: %s and value: %s", parameter, value)
+        try:
+            response = self.send("GET", path, stream=True)
+        except Exception as e:
+            logger.error("Error retrieving person information: %s", e)
+            raise ValueError(f"Error while sending HTTP GET: {e}")
+        if response.status_code != 200:
+            try:
+                person_list_from_response(response)
+            finally:
+                response.close()
+        return self._iter_response_persons(response)
+
+    def _iter_response_persons(self, response):
+        count = 0
+        failed = False
+        try:
+            for person in iter_json_array_items(_count_received_bytes(response.iter_content(chunk_size=65536))):
+                count += 1
+                yield person
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Return connection to the pool even if the client stopped reading
+            response.close()
+            if self.admission is not None:
+                self.admission.observe(time.perf_counter() - response.xroad_started, failed=failed)
+        logger.info("Streamed %s persons", count)
+
+    def update_person(self, data: dict) -> CustomResponse:
+        # Edit person information via X-Road service
+        logger.debug("Editing person information: %s", data)
+        try:
+            response = self.send("PUT", self.person_path, json=data)
+        except (requests.exceptions.RequestException, CircuitOpenError, RateLimitTimeout) as e:
+            logger.error("Error editing person information: %s", e)
+            raise ValueError(f"Error while sending HTTP PUT: {e}")
+
+        if not response.content:
+            json_body = {"message": "Nothing to display"}
+            logger.info("Edit complete, received empty response.")
+            return CustomResponse(status_code=response.status_code, body=json_body)
+
+        body = response.json()
+        logger.info("Edit complete, received response: %s", body)
+        return CustomResponse(status_code=response.status_code, body=body)
+
+    def delete_person(self, unzr: str) -> CustomResponse:
+        # Delete person information via X-Road service
+        logger.info("Deleting person with UNZR id: %s", unzr)
+        try:
+            response = self.send("DELETE", f"{self.person_path}/unzr/{unzr}")
+        except Exception as e:
+            json_body = {"Error while sending HTTP DELETE": f"{e}"}
+            logger.error("Error deleting person: %s", e)
+            return CustomResponse(status_code=500, body=json_body)
+
+        body = response.json()
+        logger.info("Delete complete, received response: %s", body)
+        return CustomResponse(status_code=response.status_code, body=body)
+
+    def create_person(self, data: dict) -> CustomResponse:
+        # Add a new person via the X-Road service
+        logger.info("Adding new person: %s", data)
+        try:
+            response = self.send("POST", self.person_path, json=data)
+            if response.status_code > 400:
+                logger.error("An error occurred while adding the person, status code: %s", response.status_code)
+        except Exception as e:
+            json_body = {"Error while sending HTTP POST": f"{e}"}
+            logger.error("Error occurred while adding new person: %s", e)
+            return CustomResponse(status_code=500, body=json_body)
+
+        body = response.json()
+        logger.info("Add request processed successfully, response received: %s", body)
+        return CustomResponse(status_code=response.status_code, body=body)
+
+
+def _count_received_bytes(chunks):
+    # Pass through chunks of streamed search response, counting their size
+    for chunk in chunks:
+        metrics.xroad_received_bytes.inc(len(chunk), operation="search")
+        yield chunk
+
+
+# Clients are kept per worker process and per configuration
+_xroad_clients = {}
+_xroad_clients_lock = threading.RLock()
+
+
+def get_xroad_client(config_instance) -> XRoadClient:
+    # Return X-Road client of the current process, creating it on first use
+    client = _xroad_clients.get(id(config_instance))
+    if client is None:
+        with _xroad_clients_lock:
+            client = _xroad_clients.get(id(config_instance))
+            if client is None:
+                client = XRoadClient(config_instance)
+                _xroad_clients[id(config_instance)] = client
+    return client
+
+
+# Retry policy and circuit breaker shared by sync and async clients of the process
+_resilience_policies = {}
+
+# Security servers of the cluster with their state, shared by sync and async clients of the process
+_balancers = {}
+_health_checkers = {}
+
+# Threads checking certificate files for changes, one per process and configuration
+_cert_watchers = {}
+
+# Person cache backends are opened per worker process and per configuration
+_person_caches = {}
+
+# Threads refreshing stale person cache entries of the process
+_cache_refreshers = {}
+
+# Full search results kept per worker process while the user pages through them
+_search_result_caches = {}
+
+# ASiC container downloads of the process and the index of containers they are recorded in
+_asic_archivers = {}
+_asic_indexes = {}
+
+# Background workers of the person mutation queue of the process
+_job_queues = {}
+
+# Metadata of listed directories, kept per worker process
+_directory_indexes = {}
+
+# Concurrency limit of requests to the security server, per worker process
+_admission_limiters = {}
+
+# Request rate limits per client/service identity, shared by all clients of the process
+_schedulers = {}
+
+# Identical concurrent searches of the process are sent to the security server only once
+coalescing_stats = FlightStats()
+person_search_flight = SingleFlight(coalescing_stats)
+
+
+def get_resilience_policy(config_instance) -> ResiliencePolicy:
+    # Return retry policy and circuit breaker of the current process
+    policy = _resilience_policies.get(id(config_instance))
+    if policy is None:
+        with _xroad_clients_lock:
+            policy = _resilience_policies.get(id(config_instance))
+            if policy is None:
+                policy = create_resilience_policy(config_instance)
+                _resilience_policies[id(config_instance)] = policy
+    return policy
+
+
+def get_balancer(config_instance) -> Balancer:
+    # Return balancer of the current process, starting health checks of a cluster on first use
+    balancer = _balancers.get(id(config_instance))
+    if balancer is None:
+        with _xroad_clients_lock:
+            balancer = _balancers.get(id(config_instance))
+            if balancer is None:
+                balancer = Balancer(get_xroad_base_uris(config_instance), config_instance.xroad_balancing,
+                                    config_instance.xroad_eject_failures, config_instance.xroad_eject_time)
+                if len(balancer.nodes) > 1 and config_instance.xroad_health_check_interval > 0:
+                    _health_checkers[id(config_instance)] = HealthChecker(
+                        balancer, create_health_check(config_instance),
+                        config_instance.xroad_health_check_interval).start()
+                _balancers[id(config_instance)] = balancer
+    return balancer
+
+
+def create_health_check(config_instance):
+    # Health check of a security server: any response below 500 to health_check_path
+    sessions = XRoadSession(config_instance)
+    timeout = (config_instance.xroad_connect_timeout, config_instance.xroad_connect_timeout)
+
+    def check(node) -> bool:
+        response = sessions.current().get(node.base_uri + config_instance.xroad_health_check_path, timeout=timeout)
+        response.close()
+        return response.status_code < 500
+
+    return check
+
+
+def get_person_cache(config_instance):
+    # Return person cache of the current process or None if caching is disabled
+    if config_instance.cache_enabled != "true":
+        return None
+    cache = _person_caches.get(id(config_instance))
+    if cache is None:
+        with _xroad_clients_lock:
+            cache = _person_caches.get(id(config_instance))
+            if cache is None:
+                cache = create_cache_backend(config_instance)
+                _person_caches[id(config_instance)] = cache
+    return cache
+
+
+def get_cache_refresher(config_instance) -> CacheRefresher:
+    # Return refresher of stale person cache entries of the current process
+    refresher = _cache_refreshers.get(id(config_instance))
+    if refresher is None:
+        with _xroad_clients_lock:
+            refresher = _cache_refreshers.get(id(config_instance))
+            if refresher is None:
+                refresher = CacheRefresher(config_instance.cache_refresh_workers)
+                _cache_refreshers[id(config_instance)] = refresher
+    return refresher
+
+
+def get_admission_limiter(config_instance):
+    # Return concurrency limiter of the current process or None if admission control is disabled
+    if config_instance.admission_enabled != "true":
+        return None
+    limiter = _admission_limiters.get(id(config_instance))
+    if limiter is None:
+        with _xroad_clients_lock:
+            limiter = _admission_limiters.get(id(config_instance))
+            if limiter is None:
+                limiter = AdaptiveLimiter(config_instance.admission_min_limit, config_instance.admission_max_limit,
+                                          config_instance.admission_initial_limit,
+                                          config_instance.admission_max_queue,
+                                          config_instance.admission_queue_timeout,
+                                          config_instance.admission_tolerance)
+                _admission_limiters[id(config_instance)] = limiter
+    return limiter
+
+
+def get_scheduler(config_instance):
+    # Return outbound scheduler of the client/service identity or None if the request rate is not limited.
+    # Configurations with the same identity share the limit of the process.
+    if config_instance.scheduler_rate <= 0:
+        return None
+    identity = (f"{config_instance.client_instance}/{config_instance.client_org_type}/"
+                f"{config_instance.client_org_code}/{config_instance.client_org_sub} "
+                f"{get_rest_xroad_path(config_instance)}")
+    scheduler = _schedulers.get(identity)
+    if scheduler is None:
+        with _xroad_clients_lock:
+            scheduler = _schedulers.get(identity)
+            if scheduler is None:
+                scheduler = OutboundScheduler(identity, config_instance.scheduler_rate,
+                                              config_instance.scheduler_burst,
+                                              config_instance.scheduler_bulk_reserve,
+                                              config_instance.scheduler_max_wait)
+                _schedulers[identity] = scheduler
+    return scheduler
+
+
+def get_search_result_cache(config_instance) -> MemoryCacheBackend:
+    # Return cache of search results used for paging
+    cache = _search_result_caches.get(id(config_instance))
+    if cache is None:
+        with _xroad_clients_lock:
+            cache = _search_result_caches.get(id(config_instance))
+            if cache is None:
+                cache = MemoryCacheBackend(config_instance.search_result_cache_entries,
+                                           config_instance.search_result_ttl)
+                _search_result_caches[id(config_instance)] = cache
+    return cache
+
+
+def get_asic_index(config_instance) -> AsicIndex:
+    # Return index of ASiC containers, opened on first use without starting downloads.
+    # Index and partial downloads are kept in the .archiver subdirectory of asic_path.
+    index = _asic_indexes.get(id(config_instance))
+    if index is None:
+        with _xroad_clients_lock:
+            index = _asic_indexes.get(id(config_instance))
+            if index is None:
+                work_directory = os.path.join(config_instance.asic_path, ".archiver")
+                os.makedirs(work_directory, exist_ok=True)
+                index = AsicIndex(os.path.join(work_directory, "index.sqlite3"))
+                _asic_indexes[id(config_instance)] = index
+    return index
+
+
+def get_asic_archiver(config_instance) -> AsicArchiver:
+    # Return ASiC archiver of the current process, starting download threads on first use
+    archiver = _asic_archivers.get(id(config_instance))
+    if archiver is None:
+        with _xroad_clients_lock:
+            archiver = _asic_archivers.get(id(config_instance))
+            if archiver is None:
+                client = get_xroad_client(config_instance)
+                params = {
+                    "xRoadInstance": config_instance.client_instance,
+                    "memberClass": config_instance.client_org_type,
+                    "memberCode": config_instance.client_org_code,
+                    "subsystemCode": config_instance.client_org_sub,
+                }
+                archiver = AsicArchiver(get_asic_index(config_instance),
+                                        config_instance.asic_path, client.sessions.current,
+                                        get_xroad_base_uris(config_instance), params, client.timeout,
+                                        config_instance.asic_workers, config_instance.asic_max_retries,
+                                        config_instance.asic_backoff_base, config_instance.asic_backoff_max).start()
+                _asic_archivers[id(config_instance)] = archiver
+    return archiver
+
+
+def archive_query(query_id: str, base_uri: str, config_instance):
+    # Queue download of the ASiC container of a completed query, errors don't affect the query itself
     try:
-        if config_instance.xroad_protocol == "https":
-            # Send HTTPS request to update person information
-            response = requests.put(url, json=data, headers=headers, params=query_params,
-                                    cert=(os.path.join(config_instance.cert_path, config_instance.cert_file),
-                                          os.path.join(config_instance.cert_path, config_instance.key_file)),
-                                    verify=os.path.join(config_instance.cert_path, config_instance.xroad_cert_file))
+        get_asic_archiver(config_instance).submit([query_id], base_uri, config_instance.asic_archive_delay)
+    except Exception as e:
+        logger.error("Queueing ASiC container of query %s failed: %s", query_id, e)
 
-            #download_asic_from_trembita(query_params.get('queryId'), config_instance)
-        else:
-            # Send HTTP request to update person information
-            response = requests.put(url, json=data, headers=headers, params=query_params)
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error editing person information: {e}")
-        raise ValueError(f"Error while sending HTTP PUT: {e}")
+def resume_asic_archive(config_instance):
+    # Start the archiver at process start if containers may be waiting for download
+    index_path = os.path.join(config_instance.asic_path, ".archiver", "index.sqlite3")
+    if config_instance.asic_archive_queries == "true" or os.path.exists(index_path):
+        get_asic_archiver(config_instance)
 
-    if not response.content:
-        json_body = {"message": "Nothing to display"}
-        logger.info("Edit complete, received empty response.")
-        return CustomResponse(status_code=response.status_code, body=json_body)
 
-    logger.info(f"Edit complete, received response: {response.json()}")
-    return CustomResponse(status_code=response.status_code, body=response.json())
+def get_asic_stats(config_instance) -> dict:
+    # Number of containers by state, empty if the index was not used by the current process
+    index = _asic_indexes.get(id(config_instance))
+    return index.counts() if index is not None else {}
 
 
-def service_delete_person(data: dict, config_instance) -> CustomResponse:
-    # Delete person information via X-Road service
-    base_url = get_rest_xroad_uri(config_instance) + "/person"
-    headers = get_xroad_headers_from_config(config_instance)
-    query_params = None  # get_uxp_query_params()
+def get_job_queue(config_instance) -> JobQueue:
+    # Return person mutation queue of the current process, starting its workers on first use
+    job_queue = _job_queues.get(id(config_instance))
+    if job_queue is None:
+        with _xroad_clients_lock:
+            job_queue = _job_queues.get(id(config_instance))
+            if job_queue is None:
+                job_queue = JobQueue(JobStore(config_instance.jobs_path, config_instance.jobs_retention),
+                                     lambda operation, data: PERSON_MUTATIONS[operation](data, config_instance),
+                                     config_instance.jobs_workers).start()
+                _job_queues[id(config_instance)] = job_queue
+    return job_queue
 
-    url = f"{base_url}/unzr/{data['unzr']}"
 
-    logger.info(f"Deleting person with UNZR id: {data['unzr']}")
-    try:
-        if config_instance.xroad_protocol == "https":
-            # Send HTTPS request to delete person
-            response = requests.delete(url, headers=headers, params=query_params,
-                                       cert=(os.path.join(config_instance.cert_path, config_instance.cert_file),
-                                             os.path.join(config_instance.cert_path, config_instance.key_file)),
-                                       verify=os.path.join(config_instance.cert_path,
-                                                           config_instance.xroad_cert_file))
-
-            # download_asic_from_trembita(query_params.get('queryId'), config_instance)
-        else:
-            # Send HTTP request to delete person
-            response = requests.delete(url, headers=headers, params=query_params)
-    except Exception as e:
-        json_body = {"Error while sending HTTP DELETE": f"{e}"}
-        logger.error(f"Error deleting person: {e}")
-        return CustomResponse(status_code=500, body=json_body)
+def resume_job_queue(config_instance):
+    # Start the job workers at process start if mutations may be waiting in the queue
+    if config_instance.jobs_async_mutations == "true" or os.path.exists(config_instance.jobs_path):
+        get_job_queue(config_instance)
 
-    logger.info(f"Delete complete, received response: {response.json()}")
-    return CustomResponse(status_code=response.status_code, body=response.json())
 
+# Set by a server which imports the application before forking workers (gunicorn preload_app):
+# background threads are started in the workers, not in the importing process
+defer_background_work = False
+
+
+def resume_background_work(config_instance):
+    # Continue mutations and downloads of ASiC containers queued before restart
+    if defer_background_work:
+        return
+    resume_job_queue(config_instance)
+    resume_asic_archive(config_instance)
 
-def service_add_person(data: dict, config_instance) -> CustomResponse:
-    # Add a new person via the X-Road service
-    base_url = get_rest_xroad_uri(config_instance) + "/person"
-    headers = get_xroad_headers_from_config(config_instance)
-    query_params = None  # get_uxp_query_params()
 
-    url = base_url
-    logger.info(f"Adding new person: {data}")
+def get_job_stats(config_instance) -> dict:
+    # Number of jobs by state, empty if the queue was not used by the current process
+    job_queue = _job_queues.get(id(config_instance))
+    return job_queue.store.counts() if job_queue is not None else {}
+
+
+def get_scheduler_stats(config_instance) -> dict:
+    # Request rate limit and queued requests of the client/service identity in the current process
+    scheduler = get_scheduler(config_instance)
+    if scheduler is None:
+        return {"enabled": False}
+    return {"enabled": True, **scheduler.stats()}
+
+
+def get_admission_stats(config_instance) -> dict:
+    # Concurrency limit and rejections of the current process
+    limiter = get_admission_limiter(config_instance)
+    if limiter is None:
+        return {"enabled": False}
+    return {"enabled": True, **limiter.stats()}
+
+
+def get_directory_index(directory: str, rescan_interval: float = 60.0) -> DirectoryIndex:
+    # Return metadata index of the directory, created on first use
+    index = _directory_indexes.get(directory)
+    if index is None:
+        with _xroad_clients_lock:
+            index = _directory_indexes.get(directory)
+            if index is None:
+                index = DirectoryIndex(directory, rescan_interval)
+                _directory_indexes[directory] = index
+    return index
+
+
+def process_alive(pid: int) -> bool:
+    # Whether the process exists, work claimed by a stopped worker process (jobs, ASiC downloads) is taken over
     try:
-        if config_instance.xroad_protocol == "https":
-            # Send HTTPS request to add new person
-            response = requests.post(url, json=data, headers=headers, params=query_params,
-                                     cert=(os.path.join(config_instance.cert_path, config_instance.cert_file),
-                                           os.path.join(config_instance.cert_path, config_instance.key_file)),
-                                     verify=os.path.join(config_instance.cert_path, config_instance.xroad_cert_file))
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _reset_process_state():
+    # Connections, caches and locks must not be shared with forked worker processes
+    global _xroad_clients_lock, coalescing_stats, person_search_flight
+    _xroad_clients.clear()
+    _resilience_policies.clear()
+    # Health check threads are not copied to the child process
+    _balancers.clear()
+    _health_checkers.clear()
+    _cert_watchers.clear()
+    _person_caches.clear()
+    _cache_refreshers.clear()
+    _search_result_caches.clear()
+    _directory_indexes.clear()
+    _asic_archivers.clear()
+    _asic_indexes.clear()
+    _job_queues.clear()
+    _admission_limiters.clear()
+    _schedulers.clear()
+    _xroad_clients_lock = threading.RLock()
+    coalescing_stats = FlightStats()
+    person_search_flight = SingleFlight(coalescing_stats)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_process_state)
+
+
+def get_pool_stats(config_instance) -> dict:
+    # Connection pool hit/miss counters of the current process
+    client = _xroad_clients.get(id(config_instance))
+    if client is None:
+        return {"hits": 0, "misses": 0}
+    return client.pool_stats.as_dict()
+
+
+def get_cache_stats(config_instance) -> dict:
+    # Person cache counters of the current process
+    cache = get_person_cache(config_instance)
+    if cache is None:
+        return {"enabled": False}
+    refresher = _cache_refreshers.get(id(config_instance))
+    refreshes = refresher.stats() if refresher is not None else {}
+    return {"enabled": True, **cache.stats(), **refreshes}
+
+
+def get_resilience_stats(config_instance) -> dict:
+    # Retry counter and circuit breaker state of the current process
+    return get_resilience_policy(config_instance).stats()
+
+
+def get_balancer_stats(config_instance) -> dict:
+    # Per security server counters and state of the current process
+    return get_balancer(config_instance).stats()
+
+
+def get_coalescing_stats() -> dict:
+    # Numbers of searches sent upstream and searches that joined an identical one in flight
+    return coalescing_stats.as_dict()
+
+
+def invalidate_cached_person(person: dict, config_instance):
+    # Drop cached searches affected by a successful change of the person
+    if not person:
+        return
+    cache = get_person_cache(config_instance)
+    if cache is not None:
+        cache.invalidate_person(person)
+    result_cache = _search_result_caches.get(id(config_instance))
+    if result_cache is not None:
+        result_cache.invalidate_person(person)
+
+
+def get_cached_person(parameter: str, value: str, config_instance):
+    # Cached search result or None. A stale result is returned immediately and refreshed in the background.
+    cache = get_person_cache(config_instance)
+    if cache is None:
+        return None
+    entry = cache.lookup((parameter, value))
+    if entry is None:
+        return None
+    persons, stale = entry
+    if stale:
+        get_cache_refresher(config_instance).submit(
+            (parameter, value), functools.partial(search_person_in_service, parameter, value, config_instance))
+        logger.debug("Stale person information for %s: %s found in cache, refreshing", parameter, value)
+    else:
+        logger.debug("Person information for %s: %s found in cache", parameter, value)
+    return persons
 
-            # download_asic_from_trembita(query_params.get('queryId'), config_instance)
-        else:
-            # Send HTTP request to add new person
-            response = requests.post(url, json=data, headers=headers, params=query_params)
 
-        if response.status_code > 400:
-            logger.error(f"An error occurred while adding the person, status code: {response.status_code}")
+def search_person_in_service(parameter: str, value: str, config_instance) -> list:
+    # Search the security server and store the result in the cache
+    persons = person_search_flight.do((id(config_instance), parameter, value),
+                                      get_xroad_client(config_instance).get_person, parameter, value)
+    cache = get_person_cache(config_instance)
+    if cache is not None:
+        cache.set((parameter, value), persons)
+    return persons
+
+
+def get_person_from_service(parameter: str, value: str, config_instance) -> list:
+    # Retrieve person information by parameter via X-Road service, using cached result if available
+    persons = get_cached_person(parameter, value, config_instance)
+    if persons is not None:
+        return persons
+    return search_person_in_service(parameter, value, config_instance)
+
+
+def get_person_page(parameter: str, value: str, page: int, size: int, config_instance,
+                    refresh: bool = False) -> dict:
+    # Retrieve one page of search results. A new search (refresh) is sent to the security server, following
+    # pages reuse its result. With the person cache enabled that cache is used, it is shared by the workers
+    # and invalidated by their mutations; otherwise the result is kept in the result cache of the process.
+    persons = None
+    result_cache = None
+    if get_person_cache(config_instance) is None:
+        result_cache = get_search_result_cache(config_instance)
+        if not refresh:
+            persons = result_cache.get((parameter, value))
+    if persons is None:
+        persons = get_person_from_service(parameter, value, config_instance)
+        if result_cache is not None:
+            result_cache.set((parameter, value), persons)
+    return person_page(persons, parameter, value, page, size)
+
+
+def person_page(persons: list, parameter: str, value: str, page: int, size: int) -> dict:
+    # One page of the search result with paging information for the templates and /search/page
+    total = len(persons)
+    pages = max(1, -(-total // size))
+    page = min(max(page, 1), pages)
+    return {
+        "search_field": parameter,
+        "search_value": value,
+        "page": page,
+        "size": size,
+        "total": total,
+        "pages": pages,
+        "items": persons[(page - 1) * size:page * size],
+    }
+
+
+def iter_person_from_service(parameter: str, value: str, config_instance):
+    # Retrieve person information as an iterator with flat memory usage regardless of result size.
+    # The request is sent immediately, so HTTP errors are raised before iteration starts.
+    persons = get_cached_person(parameter, value, config_instance)
+    if persons is not None:
+        return iter(persons)
+    return get_xroad_client(config_instance).iter_persons(parameter, value)
+
+
+def edit_person_in_service(data: dict, config_instance) -> CustomResponse:
+    # Edit person information via X-Road service
+    response = get_xroad_client(config_instance).update_person(data)
+    if response.status_code < 400:
+        invalidate_cached_person(data, config_instance)
+    return response
+
+
+def service_delete_person(data: dict, config_instance) -> CustomResponse:
+    # Delete person information via X-Road service
+    response = get_xroad_client(config_instance).delete_person(data['unzr'])
+    if response.status_code < 400:
+        invalidate_cached_person(data, config_instance)
+    return response
+
+
+def service_add_person(data: dict, config_instance) -> CustomResponse:
+    # Add a new person via the X-Road service
+    response = get_xroad_client(config_instance).create_person(data)
+    if response.status_code < 400:
+        invalidate_cached_person(data, config_instance)
+    return response
 
-    except Exception as e:
-        json_body = {"Error while sending HTTP POST": f"{e}"}
-        logger.error(f"Error occurred while adding new person: {e}")
-        return CustomResponse(status_code=500, body=json_body)
 
-    logger.info(f"Add request processed successfully, response received: {response.json()}")
-    return CustomResponse(status_code=response.status_code, body=response.json())
+# Person mutations by operation name, used by the job queue
+PERSON_MUTATIONS = {
+    'create': service_add_person,
+    'edit': edit_person_in_service,
+    'delete': service_delete_person,
+}
 
 
 def create_dir_if_not_exist(dir_path: str):
     # Create directory if it doesn't exist
-    logger.info(f"Checking existence of directory: {dir_path}")
+    logger.info("Checking existence of directory: %s", dir_path)
     if not os.path.exists(dir_path):
         # Create the directory if it's missing
         os.makedirs(dir_path)
-        logger.info(f"Directory '{dir_path}' has been created.")
+        logger.info("Directory '%s' has been created.", dir_path)
     else:
-        logger.info(f"Directory '{dir_path}' already exists.")
+        logger.info("Directory '%s' already exists.", dir_path)
 
 
 def get_files_with_metadata(directory):
-    # Retrieve list of files with metadata from the specified directory
-    logger.info(f"Retrieving file metadata from directory: {directory}")
-    files_metadata = []
-    for filename in os.listdir(directory):
-        filepath = os.path.join(directory, filename)
-        creation_time = os.path.getctime(filepath)
-        creation_time_str = datetime.fromtimestamp(creation_time).strftime('%Y-%m-%d %H:%M:%S')
-        files_metadata.append({
-            'name': filename,
-            'creation_time': creation_time_str
-        })
-    logger.info(f"File metadata retrieved: {files_metadata}")
+    # Retrieve list of files with metadata from the specified directory, newest first
+    logger.info("Retrieving file metadata from directory: %s", directory)
+    files_metadata = get_directory_index(directory).entries()
+    logger.debug("File metadata retrieved: %s", files_metadata)
     return files_metadata
@@ -33,7 +33,8 @@ After=network.target
 User=$USER
 WorkingDirectory=$(pwd)
 Environment="PATH=$(pwd)/venv/bin"
-ExecStart=$(pwd)/venv/bin/gunicorn --workers 3 --bind 0.0.0.0:5000 app:app
+ExecStart=$(pwd)/venv/bin/gunicorn --config gunicorn.conf.py
+ExecReload=/bin/kill -HUP \$MAINPID
 Restart=always
 
 [Install]